@@ -2,6 +2,14 @@ from .meteovis import *
 from .dataset import *
 from .view import *
 from .control import *
+from .geometry import *
+from .storage import *
+from .catalog import *
+from .expression import *
+from .reduction import *
+from .render import *
+from .cache import *
+from .tiles import *
 import warnings
 
 import os
@@ -17,5 +25,7 @@ if __import__("meteovis"):
         os.mkdir(CACHE_DIR)
     if not os.path.exists(TEMP_DIR):
         os.mkdir(TEMP_DIR)
+    if not os.path.exists(GEOMETRY_DIR):
+        os.mkdir(GEOMETRY_DIR)
         
     warnings.filterwarnings("ignore")
\ No newline at end of file
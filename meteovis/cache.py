@@ -0,0 +1,165 @@
+"""
+on-disk cache of rendered images
+
+Author: @jiqicn
+"""
+import os
+import time
+import hashlib
+import sqlite3
+from contextlib import closing
+from .render import LUT_SIZE, PALETTE
+
+
+CACHE_BYTES = 2 * 1024 ** 3  # disk budget of the cached images, in bytes
+MANIFEST_NAME = ".manifest.sqlite"  # hidden, so it is not taken as an image
+
+
+def image_prefix(dataset_id, cmap, vmin, vmax, palette=PALETTE):
+    """
+    prefix of the image names of a dataset rendered with the given parameters
+
+    the parameters are hashed into the name, so images rendered with other
+    parameters are never served
+
+    -parameters-
+    dataset_id[str]
+    cmap[str]: colormap name that is available in matplotlib
+    vmin, vmax[float]: value range to be colored
+    palette[bool]: images encoded as 8-bit palette PNGs, see render.RasterRenderer
+    """
+    params = repr((cmap, float(vmin), float(vmax), LUT_SIZE, palette))
+    return dataset_id + "_" + hashlib.sha1(params.encode("utf-8")).hexdigest()[:12]
+
+
+class RenderCache(object):
+    """
+    manifest of the images in a cache directory, kept in a SQLite file of the directory
+
+    images of all datasets share the disk budget, and the least recently
+    used ones are removed once the cache is over it
+    """
+    def __init__(self, cache_dir, max_bytes=CACHE_BYTES):
+        """
+        -parameters-
+        cache_dir[str]: path to the cache directory
+        max_bytes[int]: disk budget of the cached images, in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+        with closing(self.connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "name TEXT PRIMARY KEY, dataset TEXT, size INTEGER, atime REAL)"
+            )
+
+    def connect(self):
+        return sqlite3.connect(self.manifest_path, timeout=30)
+
+    def add(self, dataset_id, image_names):
+        """
+        record images of a dataset as just used, adding those not in the manifest yet
+
+        -parameters-
+        dataset_id[str]
+        image_names[list]: names of images in the cache directory, missing ones are skipped
+        """
+        now = time.time()
+        rows = []
+        for name in image_names:
+            try:
+                size = os.path.getsize(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            rows.append((name, dataset_id, size, now))
+        with closing(self.connect()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)", rows)
+
+    def size(self):
+        """
+        total size of the images in the manifest, in bytes
+        """
+        with closing(self.connect()) as conn:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+
+    def evict(self, keep=()):
+        """
+        remove the least recently used images until the cache is within its budget
+
+        -parameters-
+        keep[list]: names of images not to be removed, e.g. those of the views shown
+
+        -returns-
+        number of images removed
+        """
+        keep = set(keep)
+        total = self.size()
+        removed = []
+        with closing(self.connect()) as conn:
+            for name, size in conn.execute("SELECT name, size FROM images ORDER BY atime"):
+                if total <= self.max_bytes:
+                    break
+                if name in keep:
+                    continue
+                removed.append(name)
+                total -= size
+        self.__remove(removed)
+
+        return len(removed)
+
+    def remove_dataset(self, dataset_id):
+        """
+        remove all images of a dataset, e.g. once the dataset is removed
+
+        -parameters-
+        dataset_id[str]
+        """
+        with closing(self.connect()) as conn:
+            rows = conn.execute("SELECT name FROM images WHERE dataset = ?", (dataset_id, )).fetchall()
+        self.__remove([row[0] for row in rows])
+
+    def cleanup(self, dataset_ids=None):
+        """
+        remove orphaned images
+
+        those are images of datasets not in dataset_ids, and files of the
+        directory not in the manifest, e.g. from older versions of the cache
+
+        -parameters-
+        dataset_ids[list]: ids of the datasets still existing, None to keep images of all datasets
+
+        -returns-
+        number of images removed
+        """
+        with closing(self.connect()) as conn:
+            rows = conn.execute("SELECT name, dataset FROM images").fetchall()
+        known = set(row[0] for row in rows)
+        removed = []
+        if dataset_ids is not None:
+            dataset_ids = set(dataset_ids)
+            removed += [name for name, ds_id in rows if ds_id not in dataset_ids]
+        for fn in os.listdir(self.cache_dir):
+            if not fn.startswith('.') and fn.endswith(".png") and fn not in known:
+                removed.append(fn)
+        self.__remove(removed)
+
+        return len(removed)
+
+    def clear(self):
+        """
+        remove all images
+        """
+        self.cleanup(dataset_ids=[])
+
+    def __remove(self, image_names):
+        """
+        remove images from both disk and the manifest
+        """
+        for name in image_names:
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+        with closing(self.connect()) as conn, conn:
+            conn.executemany("DELETE FROM images WHERE name = ?", [(name, ) for name in image_names])
@@ -0,0 +1,119 @@
+"""
+catalog of the datasets in a directory
+
+Author: @jiqicn
+"""
+import os
+import sqlite3
+import h5py
+from contextlib import closing
+
+
+CATALOG_NAME = ".catalog.sqlite"  # hidden, so it is skipped when listing dataset files
+
+
+class DatasetCatalog(object):
+    """
+    index of the datasets in a directory, kept in a SQLite file of the directory
+
+    operations on datasets keep the catalog up to date, and files changed
+    by other means are detected by their mtime and size when listing
+    """
+    def __init__(self, dir_path):
+        """
+        -parameters-
+        dir_path[str]: directory of dataset files
+        """
+        self.dir_path = dir_path
+        self.catalog_path = os.path.join(dir_path, CATALOG_NAME)
+        with closing(self.connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS datasets ("
+                "file TEXT PRIMARY KEY, id TEXT, name TEXT, desc TEXT, src TEXT, "
+                "ctime REAL, mtime REAL, size INTEGER)"
+            )
+
+    def connect(self):
+        return sqlite3.connect(self.catalog_path, timeout=30)
+
+    def add(self, dataset_path):
+        """
+        add a dataset file to the catalog, or update it if already there
+
+        -parameters-
+        dataset_path[str]
+        """
+        with closing(self.connect()) as conn, conn:
+            self.__add(conn, os.path.basename(dataset_path))
+
+    def remove(self, dataset_path):
+        """
+        remove a dataset file from the catalog
+
+        -parameters-
+        dataset_path[str]
+        """
+        with closing(self.connect()) as conn, conn:
+            conn.execute(
+                "DELETE FROM datasets WHERE file = ?",
+                (os.path.basename(dataset_path), )
+            )
+
+    def sync(self):
+        """
+        bring the catalog in line with the dataset files on disk
+
+        only new files and files whose mtime or size changed are opened
+        """
+        with closing(self.connect()) as conn, conn:
+            known = {}
+            for row in conn.execute("SELECT file, mtime, size FROM datasets"):
+                known[row[0]] = (row[1], row[2])
+
+            files = set()
+            for fn in os.listdir(self.dir_path):
+                if fn.startswith('.') or not fn.endswith(".h5"):
+                    continue
+                files.add(fn)
+                stat = os.stat(os.path.join(self.dir_path, fn))
+                if known.get(fn) != (stat.st_mtime, stat.st_size):
+                    self.__add(conn, fn)
+
+            for fn in set(known) - files:
+                conn.execute("DELETE FROM datasets WHERE file = ?", (fn, ))
+
+    def list(self, sync=True):
+        """
+        list the datasets in the directory
+
+        -parameters-
+        sync[bool]: check the files on disk before listing
+
+        -returns-
+        list of [id, name, desc, src, ctime], ordered by ctime
+        """
+        if sync:
+            self.sync()
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, name, desc, src, ctime FROM datasets ORDER BY ctime"
+            ).fetchall()
+
+        return [list(row) for row in rows]
+
+    def __add(self, conn, file_name):
+        """
+        read the meta information of a dataset file into the catalog
+        """
+        dataset_path = os.path.join(self.dir_path, file_name)
+        stat = os.stat(dataset_path)
+        try:
+            with h5py.File(dataset_path, "r") as f:
+                attrs = f["meta"].attrs
+                row = (str(attrs["id"]), str(attrs["name"]), str(attrs["desc"]), str(attrs["src"]))
+        except (OSError, KeyError):
+            return  # still being written, or not a dataset file
+        conn.execute(
+            "INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (file_name, ) + row + (os.path.getctime(dataset_path), stat.st_mtime, stat.st_size)
+        )
@@ -6,27 +6,34 @@ Author: @jiqicn
 
 import ipywidgets as widgets
 from .view import CACHE_DIR, EMPTY_IMAGE
-from PIL import Image
-from io import BytesIO
+from .cache import RenderCache
+from collections import OrderedDict
 import os
 import base64
+import threading
 
 
-IMAGE_BUFFER_SIZE = 500
+IMAGE_BUFFER_BYTES = 512 * 1024 ** 2  # memory budget of the image buffer, in bytes
 ANIME_SPEED = 400  # speed control, miliseconds between every two frames
+PREFETCH_FRAMES = 8  # number of upcoming frames loaded ahead of the player
+LAZY_BLOCK = 8  # number of consecutive frames rendered together in the background
 
 
 class AnimePlayer(object):
     """
     play interactive map as animation
     """
-    def __init__(self, views):
+    def __init__(self, views, lazy=False):
         """
         -parameters-
         views[list]: list of View objects
+        lazy[bool]: render frames missing from the cache on first request and in the 
+            background, instead of expecting View.create_cache to have rendered them all
         """
         self.views = views
-        self.buffer = ImageBuffer(IMAGE_BUFFER_SIZE)
+        self.buffer = ImageBuffer(IMAGE_BUFFER_BYTES)
+        self.frames = 0  # frames shown
+        self.blocked = 0  # frames shown after waiting for images not prefetched
         
         # merge the timelines of input views into one
         self.timeline = []
@@ -35,6 +42,11 @@ class AnimePlayer(object):
         self.timeline = list(set(self.timeline))
         self.timeline.sort()
         
+        # views of tiles fetch their own tiles, the others are fed with images
+        image_views = [v for v in views if v.pyramid is None]
+        self.prefetcher = FramePrefetcher(self.buffer, image_views, self.timeline)
+        self.renderer = FrameRenderer(image_views, self.timeline) if lazy else None
+        
         # initialize the player widget
         self.player = widgets.Play(
             value=0, 
@@ -51,15 +63,14 @@ class AnimePlayer(object):
         def change_player(e):
             i = e["new"]
             raster_name = self.timeline[i]
+            self.seek(i, 1 if i >= e["old"] else -1)
             self.slider.value = raster_name
             self.update_views(raster_name)
         self.player.observe(change_player, names="value")
         
+        # the slider only moves the player, so every frame is shown once, by change_player
         def change_slider(e):
-            raster_name = e["new"]
-            i = self.timeline.index(raster_name)
-            self.player.value = i
-            self.update_views(raster_name)
+            self.player.value = self.timeline.index(e["new"])
         self.slider.observe(change_slider, names="value")
         
     def get_player(self):
@@ -72,81 +83,343 @@ class AnimePlayer(object):
             self.slider, 
         ])
     
+    def seek(self, index, step):
+        """
+        move the background work to the frame shown
+        
+        -parameters-
+        index[int]: frame shown
+        step[int]: 1 when playing forward, -1 when playing backward
+        """
+        self.prefetcher.request(index, step)
+        if self.renderer is not None:
+            self.renderer.request(index)
+    
     def update_views(self, raster_name):
         """
         update both views
         """
+        blocked = False
         for v in self.views:
-            vid = v.id
-            img_name = vid + "_" + raster_name + ".png"
+            if v.pyramid is not None:
+                v.update_tiles(raster_name)
+                continue
+            img_name = v.image_name(raster_name)
+            blocked |= img_name not in self.buffer
             img = self.buffer[img_name]
+            if img is None and self.renderer is not None and self.renderer.render(v, raster_name):
+                img = self.buffer[img_name]  # not rendered yet, render it right away
             v.update_raster(img)
+        self.frames += 1
+        self.blocked += blocked
 
     def init_views(self):
         """
         initialize the views by loading and overlaying the raster of the first timestamp
         """
         raster_name = self.timeline[0]
+        self.seek(0, 1)
         self.update_views(raster_name)
     
+    def stats(self):
+        """
+        how often the player had to wait for images, along with the usage of the buffer
+        """
+        stats = self.buffer.stats()
+        stats["frames"] = self.frames
+        stats["blocked"] = self.blocked
+        return stats
+    
+    def close(self):
+        """
+        stop prefetching and rendering, once the player is not used anymore
+        """
+        self.prefetcher.stop()
+        if self.renderer is not None:
+            self.renderer.stop()
+
+
+class FrameRenderer(object):
+    """
+    render the frames of the views missing from the cache on a background thread
+    
+    frames nearest to the one shown are rendered first, in blocks of 
+    consecutive frames, so the first frames are available right away no 
+    matter how long the timeline is
+    """
+    def __init__(self, views, timeline, cache_dir=CACHE_DIR, block_size=LAZY_BLOCK):
+        """
+        -parameters-
+        views[list]: list of View objects
+        timeline[list]: timeline of the player
+        cache_dir[str]: path to the cache directory
+        block_size[int]: maximum number of consecutive frames rendered together, 
+            fewer if the block would be over the memory budget, see View.render_block_size
+        """
+        self.views = views
+        self.timeline = timeline
+        self.cache_dir = cache_dir
+        self.block_size = block_size
+        self.index = 0  # frame shown
+        self.pending = None  # per view, frames not known to be rendered, set by the thread
+        self.running = True
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def request(self, index):
+        """
+        render the frames around index first
+        """
+        self.index = index  # read by the thread before every block
+    
+    def stop(self):
+        self.running = False
+    
+    def render(self, view, raster_name):
+        """
+        render a frame of a view right away, in the calling thread
+        
+        -returns-
+        whether a frame was rendered
+        """
+        if not view.dataset.has_raster(raster_name):
+            return False
+        with self.lock:
+            if self.pending is not None:
+                self.pending[self.views.index(view)].discard(raster_name)
+        view.render([raster_name], self.cache_dir)
+        return True
+    
+    def run(self):
+        # frames already rendered are only checked here, to keep the player responsive
+        pending = []
+        for v in self.views:
+            pending.append(set(
+                rn for rn in v.timeline 
+                if not os.path.isfile(os.path.join(self.cache_dir, v.image_name(rn)))
+            ))
+        with self.lock:
+            self.pending = pending
+        
+        # frames already cached are used again, so they are the last to be evicted
+        cache = RenderCache(self.cache_dir)
+        for v in self.views:
+            cache.add(v.id, [v.image_name(rn) for rn in v.timeline])
+        
+        while self.running:
+            view, raster_names = self.next_block()
+            if view is None:
+                break
+            view.render(raster_names, self.cache_dir)
+        
+        # keep the cache within its budget, without removing frames of the views
+        if self.running:
+            cache.evict(
+                keep=[v.image_name(rn) for v in self.views for rn in v.timeline]
+            )
+    
+    def next_block(self):
+        """
+        pick the pending frames nearest to the frame shown, forward first
         
-class ImageBuffer(dict):
+        -returns-
+        (view, raster_names), or (None, None) if all frames are rendered
+        """
+        n = len(self.timeline)
+        index = min(max(self.index, 0), n - 1)
+        with self.lock:
+            for d in range(n):
+                for i in (index + d, index - d - 1):
+                    if i < 0 or i >= n:
+                        continue
+                    for v, pending in zip(self.views, self.pending):
+                        if self.timeline[i] not in pending:
+                            continue
+                        # following frames of the view, skipping frames of other views
+                        block_size = min(self.block_size, v.render_block_size())
+                        raster_names = []
+                        for rn in v.timeline[v.timeline.index(self.timeline[i]):]:
+                            if rn not in pending or len(raster_names) == block_size:
+                                break
+                            pending.discard(rn)
+                            raster_names.append(rn)
+                        return v, raster_names
+        return None, None
+    
+    
+class FramePrefetcher(object):
+    """
+    load the upcoming frames of the views into the image buffer on a background thread
+    
+    every request gives the current frame and the play direction, the 
+    frames after it are then loaded in order, and a newer request 
+    interrupts loading and starts over from its own frame
+    """
+    def __init__(self, buffer, views, timeline, n_frames=PREFETCH_FRAMES):
+        """
+        -parameters-
+        buffer[ImageBuffer]: buffer to load images into
+        views[list]: list of View objects
+        timeline[list]: timeline of the player
+        n_frames[int]: number of frames to load ahead
+        """
+        self.buffer = buffer
+        self.views = views
+        self.timeline = timeline
+        self.n_frames = n_frames
+        self.target = None  # (index, step) of the latest request, None if served
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def request(self, index, step):
+        """
+        prefetch the frames after index
+        
+        -parameters-
+        index[int]: current frame
+        step[int]: 1 when playing forward, -1 when playing backward
+        """
+        with self.cond:
+            self.target = (index, step)
+            self.cond.notify()
+    
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+    
+    def run(self):
+        while True:
+            with self.cond:
+                while self.target is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                index, step = self.target
+                self.target = None
+            
+            for k in range(1, self.n_frames + 1):
+                i = index + k * step
+                if i < 0 or i >= len(self.timeline) or self.target is not None:
+                    break
+                for v in self.views:
+                    self.buffer.prefetch(v.image_name(self.timeline[i]))
+    
+        
+class ImageBuffer(object):
     """
-    queneing of image buffers.
+    least-recently-used buffer of images, kept as base64 data urls
     
-    only images missing from the queue will be loaded
-    old buffers will be removed when the queue is full
+    images are read from the cache directory as they are, without 
+    decoding, and the least recently used ones are evicted once the 
+    buffer is over its memory budget
     """
-    def __init__(self, buffer_size=100):
-        if not hasattr(self, '_queue'):
-            self._queue = []  # queue of image buffers, where keys (image names) stored
-        self.buffer_size = buffer_size
+    def __init__(self, max_bytes=IMAGE_BUFFER_BYTES, cache_dir=CACHE_DIR):
+        """
+        -parameters-
+        max_bytes[int]: memory budget of the buffered images, in bytes
+        cache_dir[str]: path to the cache directory of images
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.nbytes = 0  # size of the buffered images
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetched = 0
+        self._images = OrderedDict()  # image name -> data url, least recently used first
+        self._lock = threading.RLock()  # images are also loaded by FramePrefetcher
     
-    def __missing__(self, img_name):
+    def __getitem__(self, img_name):
         """
-        reload of the missing function of dict.
+        get an image from the buffer, or load it if missing
         
         -parameters-
         img_name[str]
         
         -return-
-        the image buffer in b64
+        the image buffer in b64, None if the image is not in the cache
         """
+        with self._lock:
+            img = self._images.get(img_name)
+            if img is not None:
+                self._images.move_to_end(img_name)
+                self.hits += 1
+                return img
+            self.misses += 1
+        
         img = self.load(img_name)
-        self[img_name] = img
+        if img is not None:  # missing images may be rendered later, so not buffered
+            self.put(img_name, img)
         return img
+    
+    def __contains__(self, img_name):
+        return img_name in self._images
+    
+    def __len__(self):
+        return len(self._images)
+    
+    def put(self, img_name, img):
+        """
+        add an image to the buffer, evicting the least recently used ones if over budget
+        """
+        with self._lock:
+            if img_name in self._images:
+                self.nbytes -= len(self._images[img_name])
+            self._images[img_name] = img
+            self._images.move_to_end(img_name)
+            self.nbytes += len(img)
+            while self.nbytes > self.max_bytes and len(self._images) > 1:
+                _, old = self._images.popitem(last=False)
+                self.nbytes -= len(old)
+                self.evictions += 1
+    
+    def prefetch(self, img_name):
+        """
+        load an image into the buffer ahead of use, not counted as hit or miss
+        """
+        if img_name in self:
+            return
+        img = self.load(img_name)
+        if img is not None:
+            self.put(img_name, img)
+            with self._lock:
+                self.prefetched += 1
         
     def load(self, img_name):
         """
-        load image to buffer
+        load image from the cache directory
         
         -parameters-
         img_name[str]
         
         -return-
-        the image buffer in b64
+        the image buffer in b64, None if the image does not exist
         """
-        if len(self._queue) >= self.buffer_size:
-            self.pop(self._queue.pop(0))
-        
-        # create image buffer
-        img_path = os.path.join(CACHE_DIR, img_name)
+        img_path = os.path.join(self.cache_dir, img_name)
         try:
-            img = Image.open(img_path)
-            buffered = BytesIO()
-            img.save(buffered, format="PNG")
-            img_buf = buffered.getvalue()
-            img_buf = base64.b64encode(img_buf).decode('ascii')
-            img_buf = "data:image/png;base64," + img_buf
-        except FileNotFoundError:  
-            # img_buf = EMPTY_IMAGE  # if image not exist, return empty image
-            img_buf = None
-        
-        # add image to the queue
-        self._queue.append(img_name)
-        self[img_name] = img_buf
-        
-        return img_buf
+            with open(img_path, "rb") as f:
+                img_buf = f.read()
+        except FileNotFoundError:
+            return None
+        
+        return "data:image/png;base64," + base64.b64encode(img_buf).decode('ascii')
+    
+    def stats(self):
+        """
+        usage of the buffer, for tuning its budget
+        """
+        return {
+            "images": len(self._images), 
+            "bytes": self.nbytes, 
+            "hits": self.hits, 
+            "misses": self.misses, 
+            "evictions": self.evictions, 
+            "prefetched": self.prefetched, 
+        }
     
 
 class OpacityController(object):
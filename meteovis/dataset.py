@@ -6,20 +6,37 @@ Author: @jiqicn
 import os
 import h5py
 import numpy as np
-import wradlib as wrl
 import uuid
 import multiprocessing as mp
 import time
 import json
+import queue
+import shutil
+import threading
 import numpy as np
-from scipy.interpolate import griddata
-import wradlib.ipol as ipol
+from contextlib import contextmanager
 from math import *
+from .geometry import SweepGeometry, ResamplePlan
+from .catalog import DatasetCatalog
+from .expression import Expression
+from .reduction import REDUCERS, get_reducer
+from .storage import put_frames, get_frames, discard_frames, track_frames, RasterWriter, RasterReader, LAYOUT_VERSION, CHUNK_SHAPE, \
+    DEFAULT_COMPRESSION, Quantization
 
 
 DATASET_DIR = os.getcwd() + "/dataset"
 TEMP_DIR = os.getcwd() + "/temp"
 MERGE_STEP = 1000  # step size of the merging result, in metres
+MERGE_TILE = 512  # rows and cols of the tiles merged at once, a multiple of the chunk size
+MERGE_BLOCK = 4  # number of rasters of a tile merged together by one worker
+PVOL_BATCH_SIZE = 12  # number of pvol files gridded together, i.e. one hour of 5-minute scans
+UPDATE_BYTES = 128 * 1024 ** 2  # memory budget of the block of rasters updated by one worker, in bytes
+WATCH_INTERVAL = 10  # seconds between two polls of a watched directory
+WATCH_LATENCY = 60  # maximum seconds a new file waits for its batch to fill up
+WATCH_SETTLE = 5  # seconds a file should stay unmodified before being processed
+JOB_POLL = 1  # seconds between two checks of the writer while waiting for workers
+WATCH_STOP = 60  # seconds a stopped watcher waits for the batch being appended before abandoning it
+READER_CACHE = {}  # readers of the current process, dataset path -> RasterReader, see Dataset.merge_tile
 
 
 class Colorbar(object):
@@ -44,14 +61,39 @@ class Colorbar(object):
         "RHOHV": ("Greens", 0, 1.1)
     }
 
+
+class InputFileError(Exception):
+    """
+    error of an input file itself, e.g. unreadable or coded unlike the dataset, 
+    rather than of the dataset it goes to
+    """
+    pass
+
     
 class DatasetGenerator(object):
     """
     Dataset generator that will talk with the data processing GUI
     """
     
-    def __init__(self):
+    def __init__(self, geometry_dir=None, layout=LAYOUT_VERSION, chunks=CHUNK_SHAPE, 
+                 compression=DEFAULT_COMPRESSION, quantize=False):
+        """
+        -parameters-
+        geometry_dir[str]: directory to keep radar geometries on disk, None to keep them in memory only
+        layout[int]: layout of the data group of output files, see storage.RasterWriter
+        chunks[tuple]: chunk shape (time, y, x) of layout 2
+        compression[storage.Compression]: compression policy of output files
+        quantize[bool]: store the integer counts of input files with their gain and offset, instead of floats
+        """
         self.dataset_path = "" # output dataset file
+        self.geometry_dir = geometry_dir
+        self.layout = layout
+        self.chunks = chunks
+        self.compression = compression
+        self.quantize = quantize
+        self.dataset_paths = []  # output dataset files, one per (scan, qty) selection
+        self.res = None  # rows and cols of the dataset appended to, None when creating datasets
+        self.quantizations = []  # coding of the output datasets, set by create_dataset
     
     def get_options(self, src, dir_path):
         """
@@ -121,74 +163,287 @@ class DatasetGenerator(object):
             
         return {"scans": scan_list, "qtys": qty_list}
     
-    def create_dataset(self, meta, dir_path):
+    def create_dataset(self, meta, dir_path, batch_size=PVOL_BATCH_SIZE):
         """
-        create the dataset file
+        create the dataset file(s)
+        
+        one dataset is created per (scan, qty) selection, all from a 
+        single read of every input file
         
         -parameters-
-        meta[dict]: name, desc, src, and opts
+        meta[dict]: name, desc, src, and opts, where opts of pvol are either
+            scan and qty, or selections as a list of (scan, qty)
         dir_path[str]: input files directory
+        batch_size[int]: maximum number of files processed together by one worker
+        
+        -returns-
+        list of paths of the created dataset files
         """
         
-        id = str(uuid.uuid4())
         name = meta["name"]
         desc = meta["desc"]
         src = meta["src"]
         crs = "epsg3857"
-        timeline = []
-        self.dataset_path = os.path.join(DATASET_DIR, id+".h5")
-        with h5py.File(self.dataset_path, "w") as f:
-            f.create_group("data")
-            f.create_group("meta")
         
         # get meta information that may differ on data from different sources
         if meta["src"] == "pvol":
-            options = {"scan": meta["scan"], "qty": meta["qty"]}
-            if meta["qty"][0] in Colorbar.PVOL_DEFAULT:
-                cmap = Colorbar.PVOL_DEFAULT[meta["qty"][0]]
+            if "selections" in meta:
+                selections = meta["selections"]
             else:
-                cmap = Colorbar.PVOL_DEFAULT
+                selections = [(meta["scan"], meta["qty"])]
+            selections = [(tuple(scan), tuple(qty)) for scan, qty in selections]
+            outputs = []
+            for scan, qty in selections:
+                options = {"scan": scan, "qty": qty}
+                if qty[0] in Colorbar.PVOL:
+                    cmap = Colorbar.PVOL[qty[0]]
+                else:
+                    cmap = Colorbar.PVOL_DEFAULT
+                if len(selections) > 1:
+                    ds_name = "%s %s %s" % (name, qty[0], scan[1])
+                else:
+                    ds_name = name
+                outputs.append({
+                    "id": str(uuid.uuid4()), 
+                    "name": ds_name, 
+                    "options": options, 
+                    "cmap": cmap, 
+                    "timeline": []
+                })
+        
+        self.dataset_paths = []
+        for out in outputs:
+            dataset_path = os.path.join(DATASET_DIR, out["id"]+".h5")
+            with h5py.File(dataset_path, "w") as f:
+                f.create_group("data")
+                f.create_group("meta")
+            self.dataset_paths.append(dataset_path)
+        self.dataset_path = self.dataset_paths[0]
         
         # process input files in parallel and write to the dataset file
         print("* Processing input files")
+        self.res = None
         start_time = time.time()
         file_paths = [os.path.join(dir_path, fn) for fn in os.listdir(dir_path) if not fn.startswith('.')]
-        q = mp.Manager().Queue()
-        pool = mp.Pool(mp.cpu_count()+2)
-        watcher = pool.apply_async(self.write_dataset_file, (q, ))
-        jobs = []
-        for fp in file_paths:
-            job = pool.apply_async(self.process_pvol_file, (fp, options, q))
-            jobs.append(job)
-
+        
+        # keep the coding of the first file, assuming the same for all files
+        self.quantizations = [None] * len(selections)
+        if self.quantize:
+            samples = self.read_pvol_sweeps(file_paths[0], selections)
+            for k in range(len(samples)):
+                if samples[k]["data"].dtype.kind in "ui":
+                    self.quantizations[k] = Quantization(
+                        samples[k]["data"].dtype, 
+                        samples[k]["gain"], 
+                        samples[k]["offset"], 
+                        samples[k]["nodata"]
+                    )
+        
         # result = (dt, bbox, bbox_metre, data.shape, center, radar)
-        for job in jobs:
-            result = job.get()
-            timeline.append(result[0])
-            bbox = result[1]
-            bbox_metre = result[2]
-            res = result[3]  # resolution, rows * cols
-            options["center"] = result[4]
-            options["radar"] = result[5]
-        timeline.sort()
-        q.put("kill")
-        pool.close()
-        pool.join()
+        results = self.__process_files(file_paths, selections, batch_size)
+        for k in range(len(outputs)):
+            out = outputs[k]
+            for result in results[k]:
+                out["timeline"].append(result[0])
+                out["bbox"] = result[1]
+                out["bbox_metre"] = result[2]
+                out["res"] = result[3]  # resolution, rows * cols
+                out["options"]["center"] = result[4]
+                out["options"]["radar"] = result[5]
+            out["timeline"].sort()
         print("* Finished in %.2f seconds" % (time.time() - start_time))
         
         # write meta information to the dataset file
-        with h5py.File(self.dataset_path, "r+") as f:
-            f["meta"].attrs.create("id", id)
-            f["meta"].attrs.create("name", name)
-            f["meta"].attrs.create("desc", desc)
-            f["meta"].attrs.create("src", src)
-            f["meta"].attrs.create("crs", crs)
-            f["meta"].attrs.create("res", res)
-            f["meta"].attrs.create("timeline", timeline)
-            f["meta"].attrs.create("options", json.dumps(options))
-            f["meta"].attrs.create("cmap", str(cmap))
-            f["meta"].attrs.create("bbox", bbox)
-            f["meta"].attrs.create("bbox_metre", bbox_metre)
+        for k in range(len(outputs)):
+            out = outputs[k]
+            with h5py.File(self.dataset_paths[k], "r+") as f:
+                f["meta"].attrs.create("id", out["id"])
+                f["meta"].attrs.create("name", out["name"])
+                f["meta"].attrs.create("desc", desc)
+                f["meta"].attrs.create("src", src)
+                f["meta"].attrs.create("crs", crs)
+                f["meta"].attrs.create("res", out["res"])
+                f["meta"].attrs.create("timeline", out["timeline"])
+                f["meta"].attrs.create("options", json.dumps(out["options"]))
+                f["meta"].attrs.create("cmap", str(out["cmap"]))
+                f["meta"].attrs.create("bbox", out["bbox"])
+                f["meta"].attrs.create("bbox_metre", out["bbox_metre"])
+            DatasetCatalog(DATASET_DIR).add(self.dataset_paths[k])
+        
+        return self.dataset_paths
+    
+    def append_dataset(self, dataset_path, dir_path, batch_size=PVOL_BATCH_SIZE, copy=False):
+        """
+        add input files that are not yet in an existing dataset
+        
+        -parameters-
+        dataset_path[str]: existing dataset file
+        dir_path[str]: input files directory
+        batch_size[int]: maximum number of files processed together by one worker
+        copy[bool]: append to a copy of the dataset file, see append_files
+        
+        -returns-
+        list of timestamps added
+        """
+        file_paths = [os.path.join(dir_path, fn) for fn in os.listdir(dir_path) if not fn.startswith('.')]
+        
+        return self.append_files(dataset_path, file_paths, batch_size, copy=copy)
+    
+    def append_files(self, dataset_path, file_paths, batch_size=PVOL_BATCH_SIZE, 
+                     pool=None, q=None, copy=False, stop=None):
+        """
+        add the input files whose timestamps are not yet in an existing dataset
+        
+        rasters are appended in place, and the meta information is updated 
+        last, so readers only see the new rasters once they are all written. 
+        If appending fails, the rasters already appended are removed.
+        
+        with copy, files are appended to a copy of the dataset file instead, 
+        which replaces the original once complete. It costs a copy of the 
+        whole dataset, but the original is never opened for writing, e.g. 
+        while other processes are reading it
+        
+        -parameters-
+        dataset_path[str]: existing dataset file
+        file_paths[list]: input files
+        batch_size[int]: maximum number of files processed together by one worker
+        pool[multiprocessing.Pool]: worker pool to be reused, a new one if None
+        q[multiprocessing.Manager.Queue]: writing queue to be reused with the pool
+        copy[bool]: append to a copy of the dataset file
+        stop[threading.Event]: abandon appending once set, see collect_jobs
+        
+        -returns-
+        list of timestamps added
+        
+        errors of the input files themselves are raised as InputFileError
+        """
+        with h5py.File(dataset_path, "r") as f:
+            options = json.loads(f["meta"].attrs["options"])
+            timeline = f["meta"].attrs["timeline"].tolist()
+            res = f["meta"].attrs["res"].tolist()
+            reader = RasterReader(f)
+            quantization = reader.quantization
+            if reader.layout == 1 and len(timeline) > 0:
+                quantization = Quantization.from_attrs(f["data"][timeline[0]].attrs)
+        selections = [(tuple(options["scan"]), tuple(options["qty"]))]
+        self.quantizations = [quantization]
+        self.res = res
+        
+        # only process files whose timestamps are not in the dataset yet
+        start_time = time.time()
+        existing = set(timeline)
+        new_paths = []
+        for fp in file_paths:
+            try:
+                with h5py.File(fp, "r") as f:
+                    dt = self.get_pvol_dt(f)
+            except Exception as e:
+                raise InputFileError("Unable to read %s: %s" % (fp, e))
+            if dt not in existing:
+                new_paths.append(fp)
+                existing.add(dt)
+        if len(new_paths) == 0:
+            print("* No new input files")
+            return []
+        
+        # process new files into the dataset file, or a copy of it
+        print("* Processing %d new input files" % len(new_paths))
+        self.dataset_path = dataset_path
+        if copy:
+            self.dataset_path = dataset_path + ".append"
+            shutil.copyfile(dataset_path, self.dataset_path)
+        self.dataset_paths = [self.dataset_path]
+        added = []
+        try:
+            results = self.__process_files(new_paths, selections, batch_size, pool, q, stop)
+            for result in results[0]:
+                added.append(result[0])
+                bbox = result[1]
+                bbox_metre = result[2]
+            
+            # timeline grows, so attributes are recreated rather than modified
+            with h5py.File(self.dataset_path, "r+") as f:
+                f["meta"].attrs.create("timeline", sorted(timeline + added))
+                f["meta"].attrs.create("bbox", bbox)
+                f["meta"].attrs.create("bbox_metre", bbox_metre)
+                f["meta"].attrs.create("res", res)
+        except Exception:
+            # cleanup errors are only reported, the original error is the one raised
+            try:
+                if copy:
+                    os.remove(self.dataset_path)  # the original dataset is left untouched
+                else:
+                    with h5py.File(self.dataset_path, "r+") as f:
+                        RasterWriter(f).truncate(timeline)
+            except Exception as e:
+                print("\033[91m! Unable to remove the rasters appended to %s: %s\033[0m" % (
+                    self.dataset_path, e
+                ))
+            self.dataset_path = dataset_path
+            raise
+        if copy:
+            os.replace(self.dataset_path, dataset_path)
+            self.dataset_path = dataset_path
+        DatasetCatalog(os.path.dirname(dataset_path)).add(dataset_path)
+        print("* Finished in %.2f seconds" % (time.time() - start_time))
+        
+        return sorted(added)
+    
+    def __process_files(self, file_paths, selections, batch_size, pool=None, q=None, stop=None):
+        """
+        process input files in parallel and write them to self.dataset_paths
+        
+        -parameters-
+        file_paths[list]: input files
+        selections[list]: (scan, qty) to be processed, one per dataset path
+        batch_size[int]: maximum number of files processed together by one worker
+        pool[multiprocessing.Pool]: worker pool to be reused, a new one if None
+        q[multiprocessing.Manager.Queue]: writing queue to be reused with the pool
+        stop[threading.Event]: abandon processing once set, see collect_jobs
+        
+        -returns-
+        one list of (dt, bbox, bbox_metre, shape, center, radar) per selection
+        """
+        file_paths = sorted(file_paths)  # neighbouring scans go to the same batch
+        n_workers = mp.cpu_count() + 2
+        own_pool = pool is None
+        if own_pool:
+            track_frames()
+            pool = mp.Pool(n_workers)
+        manager = None
+        if q is None:
+            manager = mp.Manager()
+            q = manager.Queue(n_workers)  # bounds the shared memory in flight
+        try:
+            watcher = pool.apply_async(self.write_dataset_file, (q, ))
+        
+            # smaller batches if there are too few files to keep all workers busy
+            batch_size = max(1, min(batch_size, ceil(len(file_paths) / n_workers)))
+            jobs = []
+            for i in range(0, len(file_paths), batch_size):
+                job = pool.apply_async(
+                    self.process_pvol_selections, 
+                    (file_paths[i:i+batch_size], selections, q)
+                )
+                jobs.append(job)
+        
+            results = [[] for _ in selections]
+            for batch_results in collect_jobs(pool, jobs, watcher, q, stop):
+                for k in range(len(selections)):
+                    results[k] += batch_results[k]
+        except BaseException:
+            if own_pool:
+                pool.terminate()
+            raise
+        finally:
+            # workers and the manager hold the files open when they were forked
+            if own_pool:
+                pool.close()
+                pool.join()
+            if manager is not None:
+                manager.shutdown()
+        
+        return results
     
     def process_pvol_file(self, file_path, options, q):
         """
@@ -204,154 +459,596 @@ class DatasetGenerator(object):
         center[list]: [lat, lon]
         radar[str]: radar station name and index
         """
+        return self.process_pvol_batch([file_path], options, q)[0]
+    
+    def process_pvol_batch(self, file_paths, options, q):
+        """
+        process a batch of pvol data files
+        
+        -parameters-
+        file_paths[list]: input files
+        options[dict]: scan and qty to be processed
+        q[multiprocessing.Manageer.Queue]: writing queue
         
-        scan = options["scan"][1]
-        qty = options["qty"][1]
+        -returns-
+        list of (dt, bbox, bbox_metre, shape, center, radar), one per file
+        """
+        selections = [(options["scan"], options["qty"])]
+        
+        return self.process_pvol_selections(file_paths, selections, q)[0]
+    
+    def process_pvol_selections(self, file_paths, selections, q):
+        """
+        process a batch of pvol data files for one or more (scan, qty) selections
+        
+        every file is read once for all selections, and sweeps of the same 
+        selection sharing the same geometry are masked, scaled and gridded 
+        together as one (N, nrays, nbins) array
+        
+        -parameters-
+        file_paths[list]: input files
+        selections[list]: (scan, qty) to be processed
+        q[multiprocessing.Manageer.Queue]: writing queue, frames of 
+            selection k are put with key k
+        
+        -returns-
+        one list of (dt, bbox, bbox_metre, shape, center, radar) per selection
+        """
+        # group sweeps by selection and geometry
+        groups = {}
+        for fp in file_paths:
+            try:
+                sweeps = self.read_pvol_sweeps(fp, selections)
+            except Exception as e:
+                raise InputFileError("Unable to read %s: %s" % (fp, e))
+            for k in range(len(selections)):
+                self.check_coding(fp, sweeps[k], self.quantizations[k])
+                key = (k, sweeps[k]["geometry"])
+                groups.setdefault(key, []).append(sweeps[k])
+        
+        results = [[] for _ in selections]
+        for (k, key), sweeps in groups.items():
+            data = np.stack([s["data"] for s in sweeps]).astype("float64")
+            gain = np.array([s["gain"] for s in sweeps])[:, None, None]
+            offset = np.array([s["offset"] for s in sweeps])[:, None, None]
+            nodata = np.array([s["nodata"] for s in sweeps])[:, None, None]
+            undetect = np.array([s["undetect"] for s in sweeps])[:, None, None]
+            
+            # mask nodata and undetect values
+            data[(data == nodata) | (data == undetect)] = np.nan
+            
+            # linear transformation to convert to physical unit
+            data *= gain
+            data += offset
+            
+            # polar-to-cartisian geometry, shared by all files from the same radar
+            geo = SweepGeometry.get(*key, cache_dir=self.geometry_dir)
+            if self.res is not None and list(geo.shape) != list(self.res):
+                raise InputFileError("Resolution of %s differs from the dataset" % ", ".join(
+                    s["dt"] for s in sweeps
+                ))
+            
+            # map data from polar grid to cartisian grid 3857
+            data = geo.grid(data)
+            
+            # back to integer counts if the dataset is quantized
+            if self.quantizations[k] is not None:
+                data = self.quantizations[k].encode(data)
+            
+            # put data to the queue, through shared memory
+            put_frames(q, [s["dt"] for s in sweeps], data, key=k)
+            for i in range(len(sweeps)):
+                results[k].append((
+                    sweeps[i]["dt"], 
+                    geo.bbox, 
+                    geo.bbox_metre, 
+                    geo.shape, 
+                    sweeps[i]["center"], 
+                    sweeps[i]["radar"]
+                ))
+        
+        return results
+    
+    @staticmethod
+    def check_coding(file_path, sweep, quantization):
+        """
+        check that a sweep is coded like the quantized dataset it goes to
+        
+        the coding of the first file is kept for the whole dataset, so values 
+        of files coded otherwise would be clipped or lose precision
+        
+        -parameters-
+        file_path[str]: input file of the sweep
+        sweep[dict]: sweep read by read_pvol_sweeps
+        quantization[storage.Quantization]: coding of the dataset, None if not quantized
+        """
+        if quantization is None:
+            return
+        if (sweep["data"].dtype != quantization.dtype or sweep["gain"] != quantization.gain 
+                or sweep["offset"] != quantization.offset or sweep["nodata"] != quantization.nodata):
+            raise InputFileError("Coding of %s (%s, gain %s, offset %s, nodata %s) differs from the dataset, %r" % (
+                file_path, sweep["data"].dtype, sweep["gain"], sweep["offset"], sweep["nodata"], quantization
+            ))
+    
+    @staticmethod
+    def read_pvol_sweep(file_path, options):
+        """
+        read the selected sweep and its attributes from a pvol data file
+        
+        -parameters-
+        file_path[str]: input file
+        options[dict]: scan and qty to be read
+        
+        -returns-
+        dict of raw data, scaling attributes, geometry key, dt, center and radar
+        """
+        selections = [(options["scan"], options["qty"])]
+        
+        return DatasetGenerator.read_pvol_sweeps(file_path, selections)[0]
+    
+    @staticmethod
+    def read_pvol_sweeps(file_path, selections):
+        """
+        read several selected sweeps and their attributes from a pvol data file
+        
+        -parameters-
+        file_path[str]: input file
+        selections[list]: (scan, qty) to be read
+        
+        -returns-
+        list of dict of raw data, scaling attributes, geometry key, dt, center and radar
+        """
+        sweeps = []
         
         # get data and necessary attributes
         with h5py.File(file_path, "r") as f:
-            data = f[scan][qty]["data"][...].astype("float64")
-            elangle = float(f[scan]["where"].attrs["elangle"])
-            rscale = float(f[scan]["where"].attrs["rscale"])
-            nbins = int(f[scan]["where"].attrs["nbins"])
-            nrays = int(f[scan]["where"].attrs["nrays"])
-            gain = float(f[scan][qty]["what"].attrs["gain"])
-            offset = float(f[scan][qty]["what"].attrs["offset"])
-            nodata = float(f[scan][qty]["what"].attrs["nodata"])
-            undetect = float(f[scan][qty]["what"].attrs["undetect"])
             lon = float(f["where"].attrs["lon"])
             lat = float(f["where"].attrs["lat"])
             height = float(f["where"].attrs["height"])
-            date = str(f["what"].attrs["date"]).split("'")[1]
-            time = str(f["what"].attrs["time"]).split("'")[1][:-2] # accurate to minutes
             radar = str(f["what"].attrs["source"]).split("'")[1]
-            dt = date + "-" + time
-            
-        # mask nodata and undetect values
-        data[data==nodata] = np.nan
-        data[data==undetect] = np.nan
+            dt = DatasetGenerator.get_pvol_dt(f)
+            for scan, qty in selections:
+                scan = scan[1]
+                qty = qty[1]
+                elangle = float(f[scan]["where"].attrs["elangle"])
+                rscale = float(f[scan]["where"].attrs["rscale"])
+                nbins = int(f[scan]["where"].attrs["nbins"])
+                nrays = int(f[scan]["where"].attrs["nrays"])
+                sweeps.append({
+                    "data": f[scan][qty]["data"][...], 
+                    "gain": float(f[scan][qty]["what"].attrs["gain"]), 
+                    "offset": float(f[scan][qty]["what"].attrs["offset"]), 
+                    "nodata": float(f[scan][qty]["what"].attrs["nodata"]), 
+                    "undetect": float(f[scan][qty]["what"].attrs["undetect"]), 
+                    "geometry": (lon, lat, height, elangle, rscale, nbins, nrays), 
+                    "dt": dt, 
+                    "center": (lat, lon), 
+                    "radar": radar
+                })
         
-        # linear transformation to convert to physical unit
-        data = data * gain + offset
-            
-        # compute polar grid
-        polar_grid = np.empty((nrays, nbins, 3))  # azimuth, range, height
-        polar_grid = wrl.georef.sweep_centroids(
-            nrays=nrays, 
-            rscale=rscale, 
-            nbins=nbins, 
-            elangle=elangle
-        )
-        
-        # compute cartisian grid of both projection epsg4326 (in degree) and epsg3857 (in metre)
-        carti_grid_4326 = wrl.georef.polar.spherical_to_proj(
-            polar_grid[..., 0], polar_grid[..., 1],                                                 
-            polar_grid[..., 2], (lon, lat, height)
-        )
-        carti_grid_3857 = wrl.georef.polar.spherical_to_proj(
-            polar_grid[..., 0], polar_grid[..., 1],                                                 
-            polar_grid[..., 2], (lon, lat, height),                                                 
-            proj=wrl.georef.projection.epsg_to_osr(3857)
-        )
-        # map data from polar grid to cartisian grid 3857
-        x = carti_grid_3857[..., 0]
-        y = carti_grid_3857[..., 1]
-        xgrid = np.linspace(x.min(), x.max(), 2*nbins)
-        ygrid = np.linspace(y.min(), y.max(), 2*nbins)
-        grid_xy = np.meshgrid(xgrid, ygrid)
-        grid_xy = np.vstack((grid_xy[0].ravel(), grid_xy[1].ravel())).transpose()
-        xy=np.concatenate([x.ravel()[:,None],y.ravel()[:,None]], axis=1)
-        data = wrl.comp.togrid(
-            xy, grid_xy, nbins*rscale, np.array([x.mean(), y.mean()]), 
-            data.ravel(), wrl.ipol.Nearest
-        )
-        data = np.ma.masked_invalid(data).reshape((len(xgrid), len(ygrid)))
-        data = np.flip(data, 0)
-        data = data.data # ignore the mask
-        
-        # bbox and coordinates of the radar station (in degree, i.e. epsg 4326)
-        bbox = [
-            [np.nanmin(carti_grid_4326[..., 1]), np.nanmin(carti_grid_4326[..., 0])],
-            [np.nanmax(carti_grid_4326[..., 1]), np.nanmax(carti_grid_4326[..., 0])],
-        ]
-        bbox_metre = [
-            [np.nanmin(carti_grid_3857[..., 1]), np.nanmin(carti_grid_3857[..., 0])],
-            [np.nanmax(carti_grid_3857[..., 1]), np.nanmax(carti_grid_3857[..., 0])],
-        ]
-        center = (lat, lon)
+        return sweeps
+    
+    @staticmethod
+    def get_pvol_dt(f):
+        """
+        get the datetime stamp of an opened pvol data file
         
-        # put data to the queue
-        q.put((dt, data))
-            
-        return (dt, bbox, bbox_metre, data.shape, center, radar)
+        -parameters-
+        f[h5py.File]
+        """
+        date = str(f["what"].attrs["date"]).split("'")[1]
+        time = str(f["what"].attrs["time"]).split("'")[1][:-2] # accurate to minutes
+        
+        return date + "-" + time
     
     def write_dataset_file(self, q):
         """
         write data into the dataset file
         
         -parameters-
-        q[multiprocessing.Manageer.Queue]: writing queue
+        q[multiprocessing.Manageer.Queue]: writing queue of frame descriptors, 
+            whose keys index self.dataset_paths
         """
-        with h5py.File(self.dataset_path, "r+") as f:
+        files = [h5py.File(dp, "r+") for dp in self.dataset_paths]
+        try:
+            writers = []
+            for k in range(len(files)):
+                writers.append(RasterWriter(
+                    files[k], self.layout, self.chunks, self.compression, 
+                    self.quantizations[k]
+                ))
             while True:
                 m = q.get()
                 if m == "kill":
                     break
-                f["data"].create_dataset(
-                    m[0], 
-                    data=m[1], 
-                    compression="gzip", 
-                    compression_opts=9
-                )
+                get_frames(m, writers[m["key"]].write)
+            for writer in writers:
+                writer.flush()
+        finally:
+            for f in files:
+                f.close()
+
+
+class DatasetWatcher(object):
+    """
+    streaming ingestion of the files landing in a directory into a dataset
+    
+    the directory is polled for new files, which are appended in batches 
+    by a persistent worker pool, so radar geometries stay cached in the 
+    workers from one batch to the next. If a file of a batch is faulty, 
+    the files are appended one by one, and the faulty ones are skipped. 
+    Files of batches failing for other reasons, e.g. the dataset being 
+    open for writing elsewhere, are retried on the next poll
+    """
+    def __init__(self, generator, dataset_path, dir_path, interval=WATCH_INTERVAL, 
+                 latency=WATCH_LATENCY, batch_size=PVOL_BATCH_SIZE):
+        """
+        -parameters-
+        generator[DatasetGenerator]: generator used to process the files
+        dataset_path[str]: existing dataset to be kept up to date
+        dir_path[str]: watched directory
+        interval[float]: seconds between two polls
+        latency[float]: maximum seconds a new file waits before being processed
+        batch_size[int]: number of files worth processing without waiting
+        """
+        self.generator = generator
+        self.dataset_path = dataset_path
+        self.dir_path = dir_path
+        self.interval = interval
+        self.latency = latency
+        self.batch_size = batch_size
+        self.seen = set()  # files processed or skipped
+        self.failed = set()  # faulty files, not retried
+        self.pending = {}  # new files -> time when they were found
+        self.n_workers = mp.cpu_count() + 2
+        self.pool = None
+        self.manager = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.abort_event = threading.Event()  # abandons the batch being appended
+    
+    def start(self):
+        """
+        start watching in a background thread
+        """
+        track_frames()
+        self.pool = mp.Pool(self.n_workers)
+        self.manager = mp.Manager()
+        self.stop_event.clear()
+        self.abort_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        print("* Watching %s" % self.dir_path)
+    
+    def stop(self, timeout=WATCH_STOP):
+        """
+        stop watching and release the worker pool
+        
+        -parameters-
+        timeout[float]: seconds to wait for the batch being appended, 
+            which is abandoned afterwards and retried once started again
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                print("\033[91m! Abandoning the batch being appended\033[0m")
+                self.abort_event.set()
+                self.thread.join()
+            self.thread = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.manager is not None:
+            self.manager.shutdown()
+            self.manager = None
+        print("* Stopped watching %s" % self.dir_path)
+    
+    def run(self):
+        """
+        poll the directory until stopped
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print("\033[91m! Error message: %s\033[0m" % e)
+            self.stop_event.wait(self.interval)
+    
+    def poll(self):
+        """
+        look for new files and process them once a batch is full or the oldest is due
+        
+        -returns-
+        list of timestamps added
+        """
+        now = time.time()
+        for fn in os.listdir(self.dir_path):
+            fp = os.path.join(self.dir_path, fn)
+            if (not fn.startswith('.') and fp not in self.seen and fp not in self.failed 
+                    and fp not in self.pending):
+                self.pending[fp] = now
+        
+        # files may still be written, wait until they are settled
+        ready = []
+        for fp in list(self.pending):
+            try:
+                if now - os.path.getmtime(fp) >= WATCH_SETTLE:
+                    ready.append(fp)
+            except FileNotFoundError:
+                self.pending.pop(fp)  # removed before being processed
+        if len(ready) == 0:
+            return []
+        oldest = min(self.pending[fp] for fp in ready)
+        if len(ready) < self.batch_size and now - oldest < self.latency:
+            return []
+        
+        found = {fp: self.pending.pop(fp) for fp in ready}
+        try:
+            return self.append(ready)
+        except InputFileError as e:
+            if len(ready) == 1:
+                self.failed.add(ready[0])
+                print("\033[91m! Skipped %s: %s\033[0m" % (ready[0], e))
+                return []
+            print("\033[91m! Faulty file in batch, appending its files one by one: %s\033[0m" % e)
+        except Exception as e:
+            self.pending.update(found)
+            print("\033[91m! Batch failed, retried on the next poll: %s\033[0m" % e)
+            return []
+        
+        added = []
+        for i in range(len(ready)):
+            try:
+                added += self.append([ready[i]])
+            except InputFileError as e:
+                self.failed.add(ready[i])
+                print("\033[91m! Skipped %s: %s\033[0m" % (ready[i], e))
+            except Exception as e:
+                self.pending.update((fp, found[fp]) for fp in ready[i:])
+                print("\033[91m! Batch failed, retried on the next poll: %s\033[0m" % e)
+                break
+        
+        return sorted(added)
+    
+    def append(self, file_paths):
+        """
+        append files to the dataset, they are seen only once appended
+        
+        every batch has its own writing queue, so nothing of a failed batch 
+        is left for the next one. The pool is terminated when a batch fails, 
+        as its workers may be blocked, and restarted for the next batch
+        
+        -parameters-
+        file_paths[list]: input files
+        
+        -returns-
+        list of timestamps added
+        """
+        if self.pool is None:
+            track_frames()
+            self.pool = mp.Pool(self.n_workers)
+        q = self.manager.Queue(self.n_workers)
+        try:
+            added = self.generator.append_files(
+                self.dataset_path, file_paths, self.batch_size, self.pool, q, 
+                stop=self.abort_event
+            )
+        except Exception:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            raise
+        self.seen.update(file_paths)
+        
+        return added
+
+
+def collect_jobs(pool, jobs, watcher, q, stop=None):
+    """
+    wait for the jobs of a pool whose results are written by a writer job of the same pool
+    
+    workers block on the bounded writing queue once the writer is gone, so 
+    the writer is checked while waiting, until it takes "kill", and the 
+    pool is terminated if it fails. If a worker fails, the writer still 
+    finishes with the results of the others and closes the file before 
+    the error is raised, so the file is never left half-written. Once stop 
+    is set, e.g. as jobs are stuck, the pool is terminated, which may leave 
+    the file half-written
+    
+    -parameters-
+    pool[multiprocessing.Pool]
+    jobs[list]: AsyncResult of the workers
+    watcher[AsyncResult]: writer job, stopped by "kill" once all jobs are done
+    q[multiprocessing.Manager.Queue]: writing queue
+    stop[threading.Event]: abandon the jobs once set
+    
+    -returns-
+    list of results of the jobs
+    """
+    def check_stop():
+        if stop is not None and stop.is_set():
+            pool.terminate()
+            discard_frames(q)
+            raise Exception("Stopped before all results were written")
+    
+    def check_writer():
+        check_stop()
+        
+        # the writer only returns on "kill", so returning before means it failed
+        if watcher.ready():
+            pool.terminate()
+            discard_frames(q)  # frames are only freed by the writer otherwise
+            watcher.get()  # raises the error of the writer
+            raise Exception("Writer stopped before all results were written")
+    
+    results = []
+    error = None
+    for job in jobs:
+        while not job.ready():
+            check_writer()
+            job.wait(JOB_POLL)
+        try:
+            results.append(job.get())
+        except Exception as e:
+            if error is None:
+                error = e
+    
+    # the queue may be full of results that a failed writer never took
+    while True:
+        check_writer()
+        try:
+            q.put("kill", timeout=JOB_POLL)
+            break
+        except queue.Full:
+            pass
+    while not watcher.ready():
+        check_stop()
+        watcher.wait(JOB_POLL)
+    watcher.get()
+    if error is not None:
+        raise error
+    
+    return results
+
+
+def parse_timeline(timeline):
+    """
+    parse timestamps like "20210101-0005" into a sorted array of datetime64
+    
+    -parameters-
+    timeline[list]: timestamps in the format of dataset timelines
+    """
+    times = np.array([
+        t[:4] + "-" + t[4:6] + "-" + t[6:8] + "T" + t[9:11] + ":" + t[11:13] 
+        for t in timeline
+    ], dtype="datetime64[m]")
+    times.sort()
+    
+    return times
+
                 
 class Dataset:
     """
     abstraction of dataset
     
     enable operations on datasets, including algebra, merging, etc.
+    
+    the dataset file is only open for the time of a read. HDF5 refuses to 
+    open a file for writing, e.g. to append to it, while it is open for 
+    reading in the same process or its forked workers, and every thread 
+    reading gets its own handle
     """
+    META = ("id", "name", "desc", "src", "crs", "res", "options", "cmap", 
+            "timeline", "bbox", "bbox_metre")  # meta attributes loaded on first access
+    
     def __init__(self, dataset_path=None):
         self.dataset_path = dataset_path
-
-        # read dataset file if it's not an empty dataset object
-        if dataset_path is not None:
-            with h5py.File(dataset_path, "r") as f:
-                self.id = f["meta"].attrs["id"]
-                self.name = f["meta"].attrs["name"]
-                self.desc = f["meta"].attrs["desc"]
-                self.src = f["meta"].attrs["src"]
-                self.crs = f["meta"].attrs["crs"]
-                self.res = f["meta"].attrs["res"]
-                self.options = json.loads(f["meta"].attrs["options"])
-                self.cmap = eval(f["meta"].attrs["cmap"])
-                self.timeline = f["meta"].attrs["timeline"].tolist()
-                self.bbox = f["meta"].attrs["bbox"].tolist()
-                self.bbox_metre = f["meta"].attrs["bbox_metre"].tolist()
-            
+    
+    def __getattr__(self, name):
+        """
+        load meta information of the dataset file on first access
+        
+        only called for missing attributes, so every meta attribute is 
+        read once and cached, or set directly like in merge
+        """
+        if name not in Dataset.META or self.__dict__.get("dataset_path") is None:
+            raise AttributeError(name)
+        with self.open() as f:
+            attrs = f["meta"].attrs
+            if name == "options":
+                value = json.loads(attrs["options"])
+            elif name == "cmap":
+                value = eval(attrs["cmap"])
+            elif name in ("timeline", "bbox", "bbox_metre"):
+                value = attrs[name].tolist()
+            else:
+                value = attrs[name]
+        self.__dict__[name] = value
+        
+        return value
+    
+    @property
+    def times(self):
+        """
+        timeline parsed as a sorted array of datetime64, loaded on first access
+        """
+        if "_times" not in self.__dict__:
+            with self.open() as f:
+                self._times = parse_timeline(f["meta"].attrs["timeline"])
+        return self._times
+    
+    def has_raster(self, raster_name):
+        """
+        check if a timestamp is in the timeline, without building the timeline list
+        
+        -parameters-
+        raster_name[str]: names that are not timestamps are never in the timeline
+        """
+        try:
+            t = parse_timeline([raster_name])[0]
+        except ValueError:
+            return False
+        i = np.searchsorted(self.times, t)
+        return i < len(self.times) and self.times[i] == t
+    
+    def open(self):
+        """
+        open the dataset file for reading, to be closed by the caller, e.g. by a with block
+        """
+        return h5py.File(self.dataset_path, "r")
+    
+    @contextmanager
+    def reader(self):
+        """
+        raster reader of the dataset file, open for the reads of a with block
+        
+        e.g. with ds.reader() as reader: reader.read(raster_name)
+        """
+        with self.open() as f:
+            yield RasterReader(f)
+    
+    def read_raster(self, raster_name):
+        """
+        read a raster of the dataset
+        
+        -parameters-
+        raster_name[str]
+        """
+        with self.reader() as reader:
+            return reader.read(raster_name)
+    
+    def read_series(self, row, col, raster_names=None):
+        """
+        read the time series of a pixel of the dataset
+        
+        -parameters-
+        row, col[int]: position of the pixel
+        raster_names[list]: timestamps to be read, default to be the whole timeline
+        """
+        if raster_names is None:
+            raster_names = self.timeline
+        with self.reader() as reader:
+            return reader.read_series(row, col, raster_names)
+    
     def remove(self):
         """
         remove dataset file from disk
         """
         os.remove(self.dataset_path)
+        DatasetCatalog(os.path.dirname(self.dataset_path)).remove(self.dataset_path)
         
-    def update(self, eq):
+    def update(self, eq, compression=DEFAULT_COMPRESSION):
         """
         update all rasters in the dataset regarding an input equation string
+        
+        -parameters-
+        eq[str]: equation string input by user
+        compression[storage.Compression]: compression policy of the new dataset
         """
-        # update rasters
-        print("Start updating %s......" % self.name, end="", flush=True)
-        pool = mp.Pool(mp.cpu_count()+2)
-        jobs = []
-        for t in self.timeline:
-            job = pool.apply_async(
-                self.update_raster, 
-                (t, eq)
-            )
-            jobs.append(job)
-        for job in jobs:
-            self.test = job.get()
-        pool.close()
-        pool.join()
+        # parse the equation once, invalid equations fail before any work is done
+        expr = Expression(eq)
         
         # create a new dataset for this updating result
         id_new = str(uuid.uuid4())
@@ -371,61 +1068,97 @@ class Dataset:
             f["meta"].attrs.create("bbox", self.bbox)
             f["meta"].attrs.create("bbox_metre", self.bbox_metre)
         
-            # read temp files and fill in the new dataset file        
-            for t in self.timeline:
-                temp_name = self.id + "_" + t + ".npz"
-                temp_path = os.path.join(TEMP_DIR, temp_name)
-                result = np.load(temp_path)["data"]
-                f["data"].create_dataset(
-                    t, 
-                    data=result, 
-                    compression="gzip", 
-                    compression_opts=9
+        # update rasters, parallelize by blocks of rasters, 
+        # results go straight to the new dataset file through a single writer
+        # a block takes the rasters read, the buffers of the equation, and 
+        # the copy handed over to the writer
+        block_size = int(UPDATE_BYTES // (int(np.prod(self.res)) * (16 + expr.cell_bytes())))
+        block_size = max(block_size, 1)
+        print("Start updating %s......" % self.name, end="", flush=True)
+        n_workers = mp.cpu_count() + 2
+        track_frames()
+        pool = mp.Pool(n_workers)
+        manager = mp.Manager()
+        q = manager.Queue(n_workers)  # bounds the shared memory in flight
+        try:
+            watcher = pool.apply_async(
+                self.write_rasters, 
+                (dataset_path_new, q, compression)
+            )
+            jobs = []
+            for i in range(0, len(self.timeline), block_size):
+                job = pool.apply_async(
+                    self.update_rasters, 
+                    (self.timeline[i:i+block_size], expr, q)
                 )
-        
-        # clean up temp files
-        for f in os.listdir(TEMP_DIR):
-            if not f.startswith('.'):
-                os.remove(os.path.join(TEMP_DIR, f))
+                jobs.append(job)
+            collect_jobs(pool, jobs, watcher, q)
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            # workers and the manager hold the files open when they were forked
+            pool.close()
+            pool.join()
+            manager.shutdown()
+        DatasetCatalog(DATASET_DIR).add(dataset_path_new)
         print("[Done]")
     
-    def update_raster(self, raster_name, eq):
+    def update_rasters(self, raster_names, expr, q):
         """
-        update a raster of dataset by a given equation
+        update a block of rasters of dataset by a given equation
         
         -parameters-
-        dataset_path[str]
-        raster_name[str]
-        eq[str]: equation string input by user
-        """
-        # alias of some numpy operations
-        sqrt = np.sqrt
+        raster_names[list]
+        expr[expression.Expression]: equation input by user, already parsed
+        q[multiprocessing.Manager.Queue]: writing queue of the new dataset
         
-        with h5py.File(self.dataset_path, "r") as f:
-            ds = f["data"][raster_name][...]
-        result = eval(eq)
-        
-        # if return is a mask, apply the mask to data
-        result_unique = np.unique(result)
-        if result_unique.size <= 2:
-            if set(result_unique).issubset(set([True, False])):
-                result = np.where(~result, np.nan, ds)
+        -returns-
+        raster_names[list]
+        """
+        with self.reader() as reader:
+            ds = reader.read_many(raster_names)
+        result = expr.evaluate(ds, out=ds)  # ds is not needed afterwards
+        put_frames(q, raster_names, result)
         
-        # write result to temp
-        temp_name = self.id + "_" + raster_name
-        temp_path = os.path.join(TEMP_DIR, temp_name)
-        np.savez_compressed(temp_path, data=result)
+        return raster_names
+    
+    @staticmethod
+    def write_rasters(dataset_path, q, compression=DEFAULT_COMPRESSION):
+        """
+        write rasters handed over by put_frames into a dataset file
         
-        return [raster_name, result]
+        -parameters-
+        dataset_path[str]
+        q[multiprocessing.Manager.Queue]: writing queue of frame descriptors
+        compression[storage.Compression]: compression policy of the rasters
+        """
+        with h5py.File(dataset_path, "r+") as f:
+            writer = RasterWriter(f, compression=compression)
+            while True:
+                m = q.get()
+                if m == "kill":
+                    break
+                get_frames(m, writer.write)
+            writer.flush()
         
-    def merge(self, mode, datasets, name, desc):
+    def merge(self, mode, datasets, name, desc, compression=DEFAULT_COMPRESSION, weights=None):
         """
         merge two or more datasets into one
 
         -parameters-
-        mode[str]: indicate in which way the datasets should be merged, options include "max", "min", "avg"
+        mode[str]: indicate in which way the datasets should be merged, options are the keys of REDUCERS,
+            including "max", "min", "avg"
         datasets[arb]: arbitrary number of datasets
+        compression[storage.Compression]: compression policy of the merging result
+        weights[list]: weight of every dataset for "avg", a number or a per-cell quality raster
+            on the merged grid, None for equal weights
         """
+        if mode not in REDUCERS:
+            raise ValueError("Unknown merging mode: %s" % mode)
+        if weights is not None and len(weights) != len(datasets):
+            raise ValueError("One weight is needed for every dataset")
+
         # initialize dataset
         self.id = str(uuid.uuid4())
         self.dataset_path = os.path.join(DATASET_DIR, self.id + ".h5")
@@ -447,6 +1180,7 @@ class Dataset:
         self.cmap = datasets[0].cmap  # since same product, cmap would also be the same
         self.timeline = datasets[0].timeline  # we assume the two datasets having the same timeline
         self.options = {}
+        self.compression = compression  # used by write_merge_result in the pool
         with h5py.File(self.dataset_path, "w") as f:
             f.create_group("data")
             f.create_group("meta")
@@ -500,136 +1234,103 @@ class Dataset:
             f["meta"].attrs.create("bbox", self.bbox)
             f["meta"].attrs.create("bbox_metre", self.bbox_metre)
 
-        # interpolate rasters, parallelize by (dataset, raster)
+        # rasters that at least one of the datasets has
+        raster_names = [t for t in self.timeline if any(ds.has_raster(t) for ds in datasets)]
+        if weights is None:
+            weights = [None] * len(datasets)
+        
+        # merge tile by tile, parallelize by (tile, block of rasters), tiles 
+        # overlapped by no dataset are skipped and left as nan
         print("Start merging %s......" % dataset_names, end="", flush=True)
-        pool = mp.Pool(mp.cpu_count()+2)
-        jobs = []
-        for ds in datasets:
-            for t in self.timeline:
-                if t not in ds.timeline:
-                    continue
-                job = pool.apply_async(
-                    self.interpolate, 
-                    (ds, t, self.bbox_metre, self.res)
-                )
-                jobs.append(job)
-        for job in jobs:
-            job.get()
-        pool.close()
-        pool.join()
-        
-        # merge rasters, parallelize by raster, and write to the dataset file
-        pool = mp.Pool(mp.cpu_count()+2)
-        q = mp.Manager().Queue()
-        watcher = pool.apply_async(self.write_merge_result, (q, ))
-        jobs = []
-        ids = []
-        for ds in datasets:
-            ids.append(ds.id) 
-        for t in self.timeline:
-            job = pool.apply_async(
-                self.merge_rasters, 
-                (ids, t, mode, q)
-            )
-            jobs.append(job)
-        for job in jobs:
-            job.get()
-        q.put("kill")
-        pool.close()
-        pool.join()
-        
-        # clean temps
-        for f in os.listdir(TEMP_DIR):
-            if not f.startswith('.'):
-                os.remove(os.path.join(TEMP_DIR, f))
+        n_workers = mp.cpu_count() + 2
+        track_frames()
+        pool = mp.Pool(n_workers)
+        manager = mp.Manager()
+        q = manager.Queue(n_workers)  # bounds the tiles in memory
+        try:
+            watcher = pool.apply_async(self.write_merge_result, (q, raster_names))
+            plans = [ResamplePlan.get(ds.bbox_metre, ds.res, self.bbox_metre, self.res) for ds in datasets]
+            jobs = []
+            for row in range(0, self.res[0], MERGE_TILE):
+                for col in range(0, self.res[1], MERGE_TILE):
+                    rows = slice(row, min(row + MERGE_TILE, self.res[0]))
+                    cols = slice(col, min(col + MERGE_TILE, self.res[1]))
+                    sources = []
+                    source_weights = []
+                    for ds, plan, w in zip(datasets, plans, weights):
+                        if plan.tile(rows, cols)[0] is None:
+                            continue
+                        sources.append((ds.dataset_path, ds.bbox_metre, ds.res))
+                        source_weights.append(w[rows, cols] if np.ndim(w) == 2 else w)
+                    if len(sources) == 0:
+                        continue
+                    for i in range(0, len(raster_names), MERGE_BLOCK):
+                        job = pool.apply_async(
+                            self.merge_tile, 
+                            (sources, source_weights, raster_names[i:i+MERGE_BLOCK], mode, 
+                             rows, cols, self.bbox_metre, self.res, q)
+                        )
+                        jobs.append(job)
+            collect_jobs(pool, jobs, watcher, q)
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            # workers and the manager hold the files open when they were forked
+            pool.close()
+            pool.join()
+            manager.shutdown()
+        DatasetCatalog(DATASET_DIR).add(self.dataset_path)
         print("[Done]")
     
     @staticmethod
-    def interpolate(dataset, raster_name, bbox_new, res_new):
+    def merge_tile(sources, weights, raster_names, mode, rows, cols, bbox_new, res_new, q):
         """
-        interpolate data stored as (x, y, z) to the new grid with bbox and cell size indicated
-
-        -parameters-
-        raster_name[str]: indicate the raster to be interpolated
-        bbox_new[list]: bbox of the target grid, [[lat_min, lon_min], [lat_max, lon_max]]
-        lat_size, lon_size[float]: cell size of the target grid
-        """
-        # compute the coordinates and values of the original dataset
-        x_step = (dataset.bbox_metre[1][1] - dataset.bbox_metre[0][1]) / dataset.res[1]
-        y_step = (dataset.bbox_metre[1][0] - dataset.bbox_metre[0][0]) / dataset.res[0]
-        x_min = dataset.bbox_metre[0][1] + 0.5 * x_step
-        x_max = dataset.bbox_metre[1][1] - 0.5 * x_step
-        y_min = dataset.bbox_metre[0][0] + 0.5 * y_step
-        y_max = dataset.bbox_metre[1][0] - 0.5 * y_step
-        x_range = np.linspace(x_min, x_max, dataset.res[1])
-        y_range = np.linspace(y_min, y_max, dataset.res[0])
-        y_range = np.flip(y_range)  # raster data stored upside down corresponding to the carte system
-        x_grid, y_grid = np.meshgrid(x_range, y_range)
-        with h5py.File(dataset.dataset_path, "r") as f:
-            z = f["data"][raster_name][...]     
-        values = z.flatten()
-        coords = np.vstack((x_grid.ravel(), y_grid.ravel())).T
-
-        # compute the x and y range of the target grid
-        x_min_new = bbox_new[0][1]
-        x_max_new = bbox_new[1][1]
-        y_min_new = bbox_new[0][0]
-        y_max_new = bbox_new[1][0]
-        x_range_new = np.linspace(x_min_new, x_max_new, res_new[1])
-        y_range_new = np.linspace(y_min_new, y_max_new, res_new[0])
-        y_range_new = np.flip(y_range_new)
-        x_grid_new, y_grid_new = np.meshgrid(x_range_new, y_range_new)
-
-        # interpolate values to the new grid
-        z_new = griddata(coords, values, (x_grid_new, y_grid_new), method="nearest")
-
-        # write data to temp files
-        temp_name = dataset.id + "_" + raster_name
-        temp_path = os.path.join(TEMP_DIR, temp_name)
-        np.savez_compressed(temp_path, data=z_new)
-
-    @staticmethod
-    def merge_rasters(ids, raster_name, mode, q):
-        """
-        merge the interpolated rasters into one
+        merge a tile of a block of rasters
+        
+        only the windows of the source rasters covering the tile are read, 
+        so memory is bounded by the tile size, not the size of the result
         
         -parameters-
-        ids[list]: list of ids of input datasets
-        raster_name[str]
+        sources[list]: (dataset_path, bbox_metre, res) of the datasets overlapping the tile
+        weights[list]: weights of the datasets, see merge, per-cell weights cut to the tile
+        raster_names[list]: timestamps of the block
         mode[str]: indicate method of merging
-        q[mp.Manager.Queue]
-        """
-        temp_paths = []
-        for ds_id in ids:
-            temp_name = ds_id + "_" + raster_name + ".npz"
-            temp_path = os.path.join(TEMP_DIR, temp_name)
-            if os.path.exists(temp_path):
-                temp_paths.append(temp_path)
-        
-        result = np.load(temp_paths[0])["data"]
-        for i in range(1, len(temp_paths)):
-            temp = np.load(temp_paths[i])["data"]
-            if mode == "avg":
-                result = np.nanmean([result, temp], axis=0)
-            elif mode == "max":
-                result = np.fmax(result, temp)
-            elif mode == "min":
-                result = np.fmin(result, temp)
-        
-        q.put((raster_name, result))
+        rows, cols[slice]: tile of the target grid
+        bbox_new[list]: bbox_metre of the target grid
+        res_new[list]: rows and cols of the target grid
+        q[mp.Manager.Queue]: writing queue of tiles
+        """
+        shape = (rows.stop - rows.start, cols.stop - cols.start)
+        reducers = [get_reducer(mode, shape) for _ in raster_names]
+        for (dataset_path, bbox, res), w in zip(sources, weights):
+            plan = ResamplePlan.get(bbox, res, bbox_new, res_new)
+            window, plan = plan.tile(rows, cols)
+            
+            # files are opened once per worker, and their time index read once
+            if dataset_path not in READER_CACHE:
+                READER_CACHE[dataset_path] = RasterReader(h5py.File(dataset_path, "r"))
+            reader = READER_CACHE[dataset_path]
+            for rn, reducer in zip(raster_names, reducers):
+                if rn in reader:
+                    reducer.add(plan.resample(reader.read_window(rn, *window)), w)
+        
+        result = np.stack([reducer.result() for reducer in reducers])
+        q.put((raster_names, result, rows.start, cols.start))
 
-    def write_merge_result(self, q):
+    def write_merge_result(self, q, raster_names):
         """
-        write merging result to dataset file
+        write merging result to dataset file, tile by tile
+        
+        -parameters-
+        q[mp.Manager.Queue]: writing queue of tiles
+        raster_names[list]: timestamps of the merging result
         """
         with h5py.File(self.dataset_path, "r+") as f:
+            writer = RasterWriter(f, compression=self.compression)
+            writer.reserve(raster_names, self.res)
             while True:
                 m = q.get()
                 if m == "kill":
                     break
-                f["data"].create_dataset(
-                    m[0], 
-                    data=m[1], 
-                    compression="gzip", 
-                    compression_opts=9
-                )
\ No newline at end of file
+                writer.write_block(*m)
@@ -0,0 +1,222 @@
+"""
+equations for updating datasets
+
+Author: @jiqicn
+"""
+import ast
+import numpy as np
+
+
+# operators and functions allowed in equations, with the type of their operands
+ARITHMETIC = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+    ast.FloorDiv: np.floor_divide,
+    ast.Mod: np.mod,
+}
+COMPARISON = {
+    ast.Gt: np.greater,
+    ast.Lt: np.less,
+    ast.GtE: np.greater_equal,
+    ast.LtE: np.less_equal,
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+}
+LOGIC = {
+    ast.BitAnd: np.logical_and,
+    ast.BitOr: np.logical_or,
+}
+FUNCTIONS = {
+    "sqrt": np.sqrt,
+    "abs": np.absolute,
+    "exp": np.exp,
+    "log": np.log,
+    "log10": np.log10,
+}
+VALUE = "value"  # type of float expressions
+MASK = "mask"  # type of boolean expressions
+
+
+class Expression(object):
+    """
+    equation input by user, parsed once and evaluated on blocks of rasters
+
+    the equation is validated into a list of numpy ufunc calls, each
+    writing into a preallocated buffer, so evaluating it neither parses
+    strings nor allocates temporary arrays. Equations of type "mask"
+    keep the values of ds where they are true, and set the others to nan.
+    """
+    def __init__(self, eq):
+        """
+        -parameters-
+        eq[str]: equation string, with the dataset named as ds
+        """
+        self.eq = eq
+        self.instructions = []  # (ufunc, operands, output register)
+        self.registers = []  # dtype of every register
+        self.free = []  # registers that can be reused
+        try:
+            tree = ast.parse(eq.strip(), mode="eval")
+        except SyntaxError:
+            raise ValueError("Invalid equation: %s" % eq)
+        self.result = self.__compile(tree.body)
+        self.type = self.__type(self.result)
+        self.shape = None  # block shape the buffers are allocated for
+        self.buffers = None  # buffers of the registers
+
+    def __repr__(self):
+        return "Expression(%r, type=%r)" % (self.eq, self.type)
+
+    def evaluate(self, ds, out=None):
+        """
+        evaluate the equation on a block of rasters
+
+        -parameters-
+        ds[np.ndarray]: rasters, of any shape
+        out[np.ndarray]: float64 array of the same shape to write the result into,
+            which may be ds itself
+
+        -returns-
+        the result, same shape as ds
+        """
+        ds = np.asarray(ds, dtype="float64")
+        if out is None:
+            out = np.empty(ds.shape)
+        if self.shape != ds.shape:
+            self.buffers = [np.empty(ds.shape, dtype=dt) for dt in self.registers]
+            self.shape = ds.shape
+
+        for ufunc, operands, reg in self.instructions:
+            args = [self.__operand(o, ds) for o in operands]
+            ufunc(*args, out=self.buffers[reg])
+
+        result = self.__operand(self.result, ds)
+        if self.type == MASK:
+            np.logical_not(result, out=result)
+            if out is not ds:
+                np.copyto(out, ds)
+            np.copyto(out, np.nan, where=result)
+        else:
+            out[...] = result
+
+        return out
+
+    def cell_bytes(self):
+        """
+        bytes of the register buffers per cell of the evaluated rasters
+        """
+        return sum(np.dtype(dt).itemsize for dt in self.registers)
+
+    def __operand(self, operand, ds):
+        kind, value = operand
+        if kind == "ds":
+            return ds
+        if kind == "const":
+            return value
+        return self.buffers[value]
+
+    def __type(self, operand):
+        kind, value = operand
+        if kind == "reg":
+            return MASK if self.registers[value] == bool else VALUE
+        return VALUE
+
+    def __register(self, dtype, operands, keep=None):
+        """
+        get an output register, reusing one of the operands if possible
+
+        operands are freed once used, except the one to keep
+        """
+        reg = None
+        for kind, value in operands:
+            if kind == "reg" and (kind, value) != keep:
+                if reg is None and self.registers[value] == dtype:
+                    reg = value
+                else:
+                    self.free.append(value)
+        if reg is None:
+            for r in self.free:
+                if self.registers[r] == dtype:
+                    self.free.remove(r)
+                    return r
+            self.registers.append(dtype)
+            reg = len(self.registers) - 1
+        return reg
+
+    def __emit(self, ufunc, operands, dtype, keep=None):
+        reg = self.__register(dtype, operands, keep)
+        self.instructions.append((ufunc, operands, reg))
+        return ("reg", reg)
+
+    def __expect(self, operand, expected, node):
+        if self.__type(operand) != expected:
+            raise ValueError("Mix of math and logic operations is not allowed: %s" % self.eq)
+
+    def __compile(self, node):
+        """
+        compile a node of the syntax tree into instructions
+
+        -returns-
+        operand holding the result, ("ds", None), ("const", value) or ("reg", index)
+        """
+        if isinstance(node, ast.Name) and node.id == "ds":
+            return ("ds", None)
+
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return ("const", float(node.value))
+
+        if isinstance(node, ast.UnaryOp):
+            operand = self.__compile(node.operand)
+            if isinstance(node.op, ast.UAdd):
+                self.__expect(operand, VALUE, node)
+                return operand
+            if isinstance(node.op, ast.USub):
+                self.__expect(operand, VALUE, node)
+                if operand[0] == "const":
+                    return ("const", -operand[1])
+                return self.__emit(np.negative, [operand], "float64")
+            if isinstance(node.op, ast.Invert):
+                self.__expect(operand, MASK, node)
+                return self.__emit(np.logical_not, [operand], bool)
+
+        if isinstance(node, ast.BinOp):
+            left = self.__compile(node.left)
+            right = self.__compile(node.right)
+            if type(node.op) in ARITHMETIC:
+                self.__expect(left, VALUE, node)
+                self.__expect(right, VALUE, node)
+                return self.__emit(ARITHMETIC[type(node.op)], [left, right], "float64")
+            if type(node.op) in LOGIC:
+                self.__expect(left, MASK, node)
+                self.__expect(right, MASK, node)
+                return self.__emit(LOGIC[type(node.op)], [left, right], bool)
+
+        if isinstance(node, ast.Compare) and all(type(op) in COMPARISON for op in node.ops):
+            # chained comparisons like 0 < ds < 10 are joined by logical and
+            result = None
+            left = self.__compile(node.left)
+            for i in range(len(node.ops)):
+                right = self.__compile(node.comparators[i])
+                self.__expect(left, VALUE, node)
+                self.__expect(right, VALUE, node)
+
+                # the right operand is also the left one of the next comparison
+                keep = right if i < len(node.ops) - 1 else None
+                cmp = self.__emit(COMPARISON[type(node.ops[i])], [left, right], bool, keep)
+                if result is None:
+                    result = cmp
+                else:
+                    result = self.__emit(np.logical_and, [result, cmp], bool)
+                left = right
+            return result
+
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+                and node.func.id in FUNCTIONS and len(node.args) == 1 and not node.keywords):
+            operand = self.__compile(node.args[0])
+            self.__expect(operand, VALUE, node)
+            return self.__emit(FUNCTIONS[node.func.id], [operand], "float64")
+
+        raise ValueError("Unsupported operation in equation: %s" % self.eq)
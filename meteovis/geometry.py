@@ -0,0 +1,299 @@
+"""
+geometry of radar sweeps and its caching
+
+Author: @jiqicn
+"""
+import os
+import copy
+import hashlib
+import numpy as np
+import wradlib as wrl
+from scipy.spatial import cKDTree
+
+
+GEOMETRY_DIR = os.getcwd() + "/geometry"
+GEOMETRY_CACHE = {}  # geometries computed in the current process, key -> SweepGeometry
+
+
+class SweepGeometry(object):
+    """
+    polar-to-cartesian geometry of a radar sweep
+
+    the geometry only depends on the radar site and the scan settings,
+    so it is computed once and shared by all files from the same radar
+    """
+    def __init__(self, lon, lat, height, elangle, rscale, nbins, nrays):
+        """
+        -parameters-
+        lon, lat, height[float]: location of the radar station
+        elangle[float]: elevation angle of the scan
+        rscale[float]: range bin size, in metres
+        nbins, nrays[int]: number of range bins and rays of the scan
+        """
+        self.key = (lon, lat, height, elangle, rscale, nbins, nrays)
+        self.lon = lon
+        self.lat = lat
+        self.height = height
+        self.elangle = elangle
+        self.rscale = rscale
+        self.nbins = nbins
+        self.nrays = nrays
+        self.x = None  # epsg3857 coordinates of bin centroids, (nrays, nbins)
+        self.y = None
+        self.bbox = None  # [[lat_min, lon_min], [lat_max, lon_max]], in degree
+        self.bbox_metre = None  # same as bbox, but in epsg3857
+        self.shape = (2 * nbins, 2 * nbins)  # rows and cols of the cartesian grid
+        self.index = None  # flat index of the nearest polar bin of every grid cell
+        self.valid = None  # grid cells within the radar range
+
+    @classmethod
+    def get(cls, lon, lat, height, elangle, rscale, nbins, nrays, cache_dir=None):
+        """
+        get the geometry from cache, or compute it if missing
+
+        -parameters-
+        lon, lat, height, elangle, rscale, nbins, nrays: see __init__
+        cache_dir[str]: directory of the on-disk cache, None to keep in memory only
+
+        -returns-
+        SweepGeometry object
+        """
+        key = (lon, lat, height, elangle, rscale, nbins, nrays)
+        if key in GEOMETRY_CACHE:
+            return GEOMETRY_CACHE[key]
+
+        geo = cls(*key)
+        if cache_dir is not None and os.path.isfile(geo.cache_path(cache_dir)):
+            geo.load(geo.cache_path(cache_dir))
+        else:
+            geo.compute()
+            if cache_dir is not None:
+                geo.save(geo.cache_path(cache_dir))
+        GEOMETRY_CACHE[key] = geo
+
+        return geo
+
+    def cache_path(self, cache_dir):
+        """
+        path of the geometry file in the on-disk cache
+        """
+        name = hashlib.sha1(repr(self.key).encode("utf-8")).hexdigest()
+        return os.path.join(cache_dir, name + ".npz")
+
+    def compute(self):
+        """
+        georeference the bin centroids of the sweep
+        """
+        # compute polar grid
+        polar_grid = wrl.georef.sweep_centroids(
+            nrays=self.nrays,
+            rscale=self.rscale,
+            nbins=self.nbins,
+            elangle=self.elangle
+        )
+        site = (self.lon, self.lat, self.height)
+
+        # compute cartisian grid of both projection epsg4326 (in degree) and epsg3857 (in metre)
+        carti_grid_4326 = wrl.georef.polar.spherical_to_proj(
+            polar_grid[..., 0], polar_grid[..., 1],
+            polar_grid[..., 2], site
+        )
+        carti_grid_3857 = wrl.georef.polar.spherical_to_proj(
+            polar_grid[..., 0], polar_grid[..., 1],
+            polar_grid[..., 2], site,
+            proj=wrl.georef.projection.epsg_to_osr(3857)
+        )
+        self.x = carti_grid_3857[..., 0]
+        self.y = carti_grid_3857[..., 1]
+
+        # bbox of the sweep
+        self.bbox = [
+            [np.nanmin(carti_grid_4326[..., 1]), np.nanmin(carti_grid_4326[..., 0])],
+            [np.nanmax(carti_grid_4326[..., 1]), np.nanmax(carti_grid_4326[..., 0])],
+        ]
+        self.bbox_metre = [
+            [np.nanmin(carti_grid_3857[..., 1]), np.nanmin(carti_grid_3857[..., 0])],
+            [np.nanmax(carti_grid_3857[..., 1]), np.nanmax(carti_grid_3857[..., 0])],
+        ]
+        self.compute_plan()
+
+    def compute_plan(self):
+        """
+        compute the nearest-neighbour mapping from polar bins to the cartesian grid
+
+        same as wrl.comp.togrid with wrl.ipol.Nearest, but done only once,
+        cells are stored in the order of the flipped (north-up) raster
+        """
+        x = self.x
+        y = self.y
+        xgrid = np.linspace(x.min(), x.max(), self.shape[1])
+        ygrid = np.linspace(y.min(), y.max(), self.shape[0])
+        grid_xy = np.meshgrid(xgrid, ygrid)
+        grid_xy = np.vstack((grid_xy[0].ravel(), grid_xy[1].ravel())).transpose()
+        xy = np.concatenate([x.ravel()[:, None], y.ravel()[:, None]], axis=1)
+
+        # only cells within the radar range get a value
+        center = np.array([x.mean(), y.mean()])
+        radius = self.nbins * self.rscale
+        ix = wrl.comp.extract_circle(center, radius, grid_xy)
+        _, nearest = cKDTree(xy).query(grid_xy[ix], k=1)
+        index = np.zeros(len(grid_xy), dtype=np.intp)
+        index[ix] = nearest
+        valid = np.zeros(len(grid_xy), dtype=bool)
+        valid[ix] = True
+
+        self.index = np.flip(index.reshape(self.shape), 0).ravel()
+        self.valid = np.flip(valid.reshape(self.shape), 0).ravel()
+
+    def grid(self, data):
+        """
+        map polar data to the cartesian grid with the precomputed plan
+
+        -parameters-
+        data[np.ndarray]: polar data of shape (..., nrays, nbins)
+
+        -returns-
+        gridded data of shape (..., rows, cols), nan out of the radar range
+        """
+        lead = data.shape[:-2]
+        data = data.reshape(lead + (-1, ))
+        result = np.take(data, self.index, axis=-1)
+        result[..., ~self.valid] = np.nan
+
+        return result.reshape(lead + self.shape)
+
+    def save(self, path):
+        """
+        save the geometry to disk
+
+        the file is written aside and renamed, as several workers may
+        compute the same geometry at the same time
+        """
+        temp_path = "%s.%d.npz" % (path[:-4], os.getpid())
+        np.savez(
+            temp_path,
+            x=self.x,
+            y=self.y,
+            bbox=self.bbox,
+            bbox_metre=self.bbox_metre,
+            index=self.index,
+            valid=self.valid
+        )
+        os.replace(temp_path, path)
+
+    def load(self, path):
+        """
+        load the geometry from disk
+        """
+        with np.load(path) as f:
+            self.x = f["x"]
+            self.y = f["y"]
+            self.bbox = f["bbox"].tolist()
+            self.bbox_metre = f["bbox_metre"].tolist()
+            if "index" in f.files:
+                self.index = f["index"]
+                self.valid = f["valid"]
+        if self.index is None:
+            self.compute_plan()  # files cached before gridding plans existed
+
+
+RESAMPLE_CACHE = {}  # resampling plans of the current process, key -> ResamplePlan
+
+
+class ResamplePlan(object):
+    """
+    nearest-neighbour resampling between two regular epsg3857 grids
+
+    both grids are axis-aligned, so the nearest source cell of every
+    target cell is found per axis, without any tree. Target cells outside
+    the source grid get nan.
+    """
+    def __init__(self, bbox_src, res_src, bbox_dst, res_dst):
+        """
+        -parameters-
+        bbox_src[list]: bbox_metre of the source grid, [[y_min, x_min], [y_max, x_max]]
+        res_src[list]: rows and cols of the source grid
+        bbox_dst, res_dst: same for the target grid
+        """
+        # source rasters are stored north-up, with cells of equal size
+        y_step = (bbox_src[1][0] - bbox_src[0][0]) / res_src[0]
+        x_step = (bbox_src[1][1] - bbox_src[0][1]) / res_src[1]
+
+        # cell centres of the target grid, also stored north-up
+        y_dst = np.flip(np.linspace(bbox_dst[0][0], bbox_dst[1][0], res_dst[0]))
+        x_dst = np.linspace(bbox_dst[0][1], bbox_dst[1][1], res_dst[1])
+
+        # source cell containing every target centre, i.e. the nearest source centre
+        rows = np.floor((bbox_src[1][0] - y_dst) / y_step).astype(np.intp)
+        cols = np.floor((x_dst - bbox_src[0][1]) / x_step).astype(np.intp)
+        self.row_valid = (rows >= 0) & (rows < res_src[0])
+        self.col_valid = (cols >= 0) & (cols < res_src[1])
+        self.rows = np.where(self.row_valid, rows, 0)
+        self.cols = np.where(self.col_valid, cols, 0)
+        self.shape = (int(res_dst[0]), int(res_dst[1]))
+
+    @classmethod
+    def get(cls, bbox_src, res_src, bbox_dst, res_dst):
+        """
+        get the plan from cache, or compute it if missing
+
+        -parameters-
+        see __init__
+
+        -returns-
+        ResamplePlan object
+        """
+        key = (
+            tuple(np.ravel(bbox_src).tolist()), tuple(np.ravel(res_src).tolist()),
+            tuple(np.ravel(bbox_dst).tolist()), tuple(np.ravel(res_dst).tolist())
+        )
+        if key not in RESAMPLE_CACHE:
+            RESAMPLE_CACHE[key] = cls(bbox_src, res_src, bbox_dst, res_dst)
+        return RESAMPLE_CACHE[key]
+
+    def resample(self, data):
+        """
+        resample rasters to the target grid
+
+        -parameters-
+        data[np.ndarray]: source rasters of shape (..., rows, cols)
+
+        -returns-
+        float rasters of shape (..., rows, cols) of the target grid
+        """
+        result = data[..., self.rows[:, None], self.cols[None, :]].astype("float64")
+        result[..., ~self.row_valid, :] = np.nan
+        result[..., :, ~self.col_valid] = np.nan
+        return result
+
+    def tile(self, rows, cols):
+        """
+        plan of a tile of the target grid, and the source window it reads
+
+        -parameters-
+        rows, cols[slice]: tile of the target grid
+
+        -returns-
+        (window, plan), window being the (rows, cols) slices of the source grid,
+        or (None, None) if the tile does not overlap the source grid
+        """
+        row_valid = self.row_valid[rows]
+        col_valid = self.col_valid[cols]
+        if not row_valid.any() or not col_valid.any():
+            return None, None
+
+        # target cells are ordered, so the source cells are within a window
+        src_rows = self.rows[rows][row_valid]
+        src_cols = self.cols[cols][col_valid]
+        window = (
+            slice(int(src_rows.min()), int(src_rows.max()) + 1),
+            slice(int(src_cols.min()), int(src_cols.max()) + 1)
+        )
+
+        plan = copy.copy(self)
+        plan.row_valid = row_valid
+        plan.col_valid = col_valid
+        plan.rows = np.where(row_valid, self.rows[rows] - window[0].start, 0)
+        plan.cols = np.where(col_valid, self.cols[cols] - window[1].start, 0)
+        plan.shape = (len(row_valid), len(col_valid))
+        return window, plan
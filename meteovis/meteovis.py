@@ -4,7 +4,10 @@ GUIs of processing data, listing datasets, and visualizing data
 Author: @jiqicn
 """
 from .dataset import DatasetGenerator, Dataset, DATASET_DIR
-from .view import View
+from .geometry import GEOMETRY_DIR
+from .catalog import DatasetCatalog
+from .view import View, CACHE_DIR
+from .cache import RenderCache
 from .control import AnimePlayer, OpacityController
 
 import ipywidgets as widgets
@@ -26,7 +29,7 @@ def process_data():
     -returns-
     object of data-processing GUI
     """
-    dg = DatasetGenerator()
+    dg = DatasetGenerator(GEOMETRY_DIR)
     
     # define the GUI
     w_title = widgets.HTML(
@@ -99,13 +102,14 @@ def process_data():
                 w_src.value = w_src.options[0]
             else:
                 if w_src.value == "pvol":
-                    w_scan = widgets.Dropdown(
+                    # one dataset per selected (scan, quantity) pair
+                    w_scan = widgets.SelectMultiple(
                         description="<b>Scan</b>", 
-                        options=options["scans"]
+                        options=[o for o in options["scans"] if o[1] != ""]
                     )
-                    w_qty = widgets.Dropdown(
+                    w_qty = widgets.SelectMultiple(
                         description="<b>Quantity</b>", 
-                        options=options["qtys"]
+                        options=[o for o in options["qtys"] if o[1] != ""]
                     )
                     w_options.children += (
                         w_scan, 
@@ -122,7 +126,7 @@ def process_data():
         """
         reset the whole gui
         """
-        dg = DatasetGenerator()
+        dg = DatasetGenerator(GEOMETRY_DIR)
         w_name.value = ""
         w_desc.value = ""
         w_path.reset()
@@ -146,14 +150,9 @@ def process_data():
         }
         if w_src.value == "pvol":
             # w_scan and w_qty should be defined in this branch
-            meta["scan"] = (
-                w_options.children[0].label, 
-                w_options.children[0].value
-            )
-            meta["qty"] = (
-                w_options.children[1].label, 
-                w_options.children[1].value
-            )
+            scans = zip(w_options.children[0].label, w_options.children[0].value)
+            qtys = list(zip(w_options.children[1].label, w_options.children[1].value))
+            meta["selections"] = [(scan, qty) for scan in scans for qty in qtys]
         elif w_src.value == "era5":
             pass
         
@@ -162,7 +161,7 @@ def process_data():
                 if w_path.value == "" or w_path.value is None:
                     raise Exception("\033[91m! Please select your data folder\033[0m")
                 for k in meta:
-                    if meta[k] == "" or meta[k] is None or meta[k] == ("", ""):
+                    if meta[k] == "" or meta[k] is None or meta[k] == ("", "") or meta[k] == []:
                         raise Exception("\033[91m! Field %s is empty\033[0m" % k)
                 dg.create_dataset(meta, w_path.value)
             except Exception as e:
@@ -280,7 +279,8 @@ def operate_datasets(dir_path=DATASET_DIR):
             widgets.HTML("<p><b>Input your equation to update a dataset</b></p>" +
                         "<p>Supported Operations:</p>" + 
                         "<p>1. Math operations: +, -, *, /, ** (power), // (floor division), % (Modulus).</p>" + 
-                        "<p>2. Logic operations: >, <, >=, <=, ==, !=, & (logical and), | (logical or).</p>" + 
+                        "<p>2. Logic operations: >, <, >=, <=, ==, !=, & (logical and), | (logical or), ~ (logical not).</p>" + 
+                        "<p>3. Functions: sqrt, abs, exp, log, log10.</p>" + 
                         "<p>Examples: </p>" + 
                         "<p>1. ds ** (1/2): computing square root of the dataset.</p>" + 
                         "<p>2. (ds<0) | (ds>10): removing value in [0, 10] from the dataset." + 
@@ -303,18 +303,9 @@ def operate_datasets(dir_path=DATASET_DIR):
         refresh dataset information
         """
         dataset_info = []
-        for dn in os.listdir(dir_path):
-            if not dn.startswith('.'):
-                dp = os.path.join(dir_path, dn)
-                ds = Dataset(dp)
-                ctime = time.ctime(os.path.getctime(dp))
-                dataset_info.append([
-                    ds.id, 
-                    ds.name, 
-                    ds.desc, 
-                    ds.src,
-                    ctime
-                ])
+        for row in DatasetCatalog(dir_path).list():
+            row[4] = time.ctime(row[4])  # create time
+            dataset_info.append(row)
         dataset_info = pd.DataFrame(
             dataset_info, 
             columns=[
@@ -338,7 +329,10 @@ def operate_datasets(dir_path=DATASET_DIR):
         for dn in ids_to_remove:
             dn = dn + ".h5"
             dp = os.path.join(dir_path, dn)
-            Dataset(dp).remove()
+            ds = Dataset(dp)
+            ds_id = ds.id
+            ds.remove()
+            RenderCache(CACHE_DIR).remove_dataset(ds_id)  # images of the dataset are not needed anymore
         refresh_on_click()
     w_remove.on_click(remove_on_click)
     
@@ -359,9 +353,12 @@ def operate_datasets(dir_path=DATASET_DIR):
                 f["meta"].attrs.modify("id", id_new)
                 old_name = f["meta"].attrs["name"]
                 f["meta"].attrs.modify("name", "COPY " + old_name)
+            DatasetCatalog(dir_path).add(dst_path)
         refresh_on_click()
     w_copy.on_click(copy_on_click)
     
+    players = []  # animation player shown
+    
     def select_vis_on_click(b=None):
         """
         show views of the selected dataset(s)
@@ -378,14 +375,15 @@ def operate_datasets(dir_path=DATASET_DIR):
             v = View(ds)
             views.append(v)
         
-        # render datasets into cache
+        # frames are rendered on first request and in the background, so maps show right away
         w_vis_output.clear_output()
-        for v in views:
-            with w_vis_output:
-                v.create_cache()
         
-        # initialize controls and views
-        ap = AnimePlayer(views)
+        # initialize controls and views, the player shown before stops prefetching
+        for ap in players:
+            ap.close()
+        players.clear()
+        ap = AnimePlayer(views, lazy=True)
+        players.append(ap)
         ap.init_views()
         oc = OpacityController(views)
         
@@ -0,0 +1,118 @@
+"""
+streaming reduction of rasters, used for merging datasets
+
+Author: @jiqicn
+"""
+import numpy as np
+
+
+class Reducer(object):
+    """
+    accumulator of rasters of the same shape
+
+    rasters are added one at a time into preallocated buffers, so the
+    memory used does not grow with the number of inputs. nan cells of an
+    input are ignored, cells without any valid input end up as nan.
+    """
+    def __init__(self, shape):
+        """
+        -parameters-
+        shape[tuple]: shape of the rasters
+        """
+        self.shape = tuple(shape)
+
+    def add(self, frame, weight=None):
+        """
+        add a raster, which may be modified in place
+
+        -parameters-
+        frame[np.ndarray]: float raster
+        weight[float or np.ndarray]: weight of the raster, scalar or per cell
+        """
+        raise NotImplementedError
+
+    def result(self):
+        """
+        -returns-
+        the reduced raster
+        """
+        raise NotImplementedError
+
+
+class MaxReducer(Reducer):
+    """
+    cell-wise maximum
+    """
+    ufunc = np.fmax
+
+    def __init__(self, shape):
+        super().__init__(shape)
+        self.value = np.full(self.shape, np.nan)
+
+    def add(self, frame, weight=None):
+        self.ufunc(self.value, frame, out=self.value)
+
+    def result(self):
+        return self.value
+
+
+class MinReducer(MaxReducer):
+    """
+    cell-wise minimum
+    """
+    ufunc = np.fmin
+
+
+class MeanReducer(Reducer):
+    """
+    cell-wise (weighted) average, from a running sum and a running weight
+
+    the result is exact for any number of inputs, unlike folding pairs
+    of rasters with nanmean. Weights default to 1, per-cell weights can
+    be used for quality-weighted averages.
+    """
+    def __init__(self, shape):
+        super().__init__(shape)
+        self.total = np.zeros(self.shape)
+        self.weight = np.zeros(self.shape)
+
+    def add(self, frame, weight=None):
+        valid = ~np.isnan(frame)
+        if weight is None:
+            np.add(self.total, frame, out=self.total, where=valid)
+            np.add(self.weight, 1, out=self.weight, where=valid)
+        else:
+            weight = np.broadcast_to(np.asarray(weight, dtype="float64"), self.shape)
+            np.multiply(frame, weight, out=frame, where=valid)
+            np.add(self.total, frame, out=self.total, where=valid)
+            np.add(self.weight, weight, out=self.weight, where=valid)
+
+    def result(self):
+        empty = self.weight == 0
+        np.divide(self.total, self.weight, out=self.total, where=~empty)
+        self.total[empty] = np.nan
+        return self.total
+
+
+# merging modes, more modes can be added by registering a Reducer subclass
+REDUCERS = {
+    "avg": MeanReducer,
+    "max": MaxReducer,
+    "min": MinReducer,
+}
+
+
+def get_reducer(mode, shape):
+    """
+    create the reducer of a merging mode
+
+    -parameters-
+    mode[str]: key of REDUCERS
+    shape[tuple]: shape of the rasters
+
+    -returns-
+    Reducer object
+    """
+    if mode not in REDUCERS:
+        raise ValueError("Unknown merging mode: %s" % mode)
+    return REDUCERS[mode](shape)
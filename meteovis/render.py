@@ -0,0 +1,200 @@
+"""
+rendering of rasters into images
+
+Author: @jiqicn
+"""
+import os
+import io
+import time
+import base64
+import threading
+import h5py
+import numpy as np
+import matplotlib.pyplot as plt
+from PIL import Image
+from .storage import RasterReader
+
+
+LUT_SIZE = 256  # number of colors of a colormap lookup table
+PALETTE = True  # encode images as 8-bit palette PNGs by default, instead of RGBA
+RENDERER_CACHE = {}  # renderers of the current process, (cmap, vmin, vmax, palette) -> RasterRenderer
+
+
+class RasterRenderer(object):
+    """
+    map raster values to RGBA pixels through a colormap lookup table
+
+    the table holds LUT_SIZE colors sampled from the matplotlib colormap,
+    plus a transparent entry for nan. Values are binned like imshow does,
+    with values out of [vmin, vmax] taking the colors at both ends, so
+    every image takes one pass of arithmetic and one table lookup.
+
+    in palette mode the table itself is the palette of 8-bit PNGs, shared
+    by all frames, and the cells are written as table indices. A palette
+    holds at most 256 entries, so one color less is sampled to leave room
+    for the nan entry.
+    """
+    def __init__(self, cmap, vmin, vmax, palette=PALETTE):
+        """
+        -parameters-
+        cmap[str]: colormap name that is available in matplotlib
+        vmin, vmax[float]: value range to be colored
+        palette[bool]: encode 8-bit palette PNGs instead of RGBA PNGs
+        """
+        self.cmap = cmap
+        self.vmin = float(vmin)
+        self.vmax = float(vmax)
+        self.palette = palette
+        self.n_colors = LUT_SIZE - 1 if palette else LUT_SIZE
+        self.lut = np.zeros((self.n_colors + 1, 4), dtype=np.uint8)  # last entry for nan
+        self.lut[:self.n_colors] = plt.get_cmap(cmap, self.n_colors)(np.arange(self.n_colors), bytes=True)
+        self.palette_rgb = self.lut[:, :3].tobytes()  # palette and its alpha, for palette mode
+        self.palette_alpha = self.lut[:, 3].tobytes()
+
+    @classmethod
+    def get(cls, cmap, vmin, vmax, palette=PALETTE):
+        """
+        get the renderer from cache, or create it if missing
+        """
+        key = (cmap, vmin, vmax, palette)
+        if key not in RENDERER_CACHE:
+            RENDERER_CACHE[key] = cls(cmap, vmin, vmax, palette)
+        return RENDERER_CACHE[key]
+
+    def index(self, raster):
+        """
+        lookup table index of every cell
+
+        -parameters-
+        raster[np.ndarray]: float raster
+
+        -returns-
+        integer array of the same shape, n_colors for nan, uint8 in palette mode
+        """
+        scale = self.n_colors / (self.vmax - self.vmin)
+        index = np.subtract(raster, self.vmin, dtype="float64")
+        index *= scale
+        np.clip(index, 0, self.n_colors - 1, out=index)
+        index[np.isnan(index)] = self.n_colors
+        return index.astype(np.uint8 if self.palette else np.intp)
+
+    def cell_bytes(self):
+        """
+        peak bytes of the arrays allocated by save_block per cell, beyond the rasters themselves
+        """
+        if self.palette:
+            return 8 + 1  # float64 index, cast to uint8
+        return 8 + 8  # float64 index, cast to intp, which then takes RGBA pixels of 4 bytes
+
+    def rgba(self, raster):
+        """
+        -parameters-
+        raster[np.ndarray]: float raster, or a block of rasters of shape (n, rows, cols)
+
+        -returns-
+        uint8 array with a last axis of RGBA, e.g. (rows, cols, 4)
+        """
+        return self.lut[self.index(raster)]
+
+    def png(self, raster):
+        """
+        render a raster into PNG bytes, one pixel per cell
+        """
+        if self.palette:
+            return self.encode_index(self.index(raster))
+        return self.encode(self.rgba(raster))
+
+    def save(self, raster, image_path):
+        """
+        render a raster into a PNG file
+        """
+        write_image(self.png(raster), image_path)
+
+    def save_block(self, rasters, image_paths):
+        """
+        render a block of rasters into PNG files, mapping colors of the block at once
+
+        -parameters-
+        rasters[np.ndarray]: rasters of shape (n, rows, cols)
+        image_paths[list]: n paths of the images
+        """
+        if self.palette:
+            index = self.index(rasters)
+            for i, image_path in enumerate(image_paths):
+                write_image(self.encode_index(index[i]), image_path)
+            return
+        rgba = self.rgba(rasters)
+        for i, image_path in enumerate(image_paths):
+            write_image(self.encode(rgba[i]), image_path)
+
+    def encode_index(self, index):
+        """
+        encode table indices of shape (rows, cols) into 8-bit palette PNG bytes
+        """
+        img = Image.fromarray(index, "P")
+        img.putpalette(self.palette_rgb)
+        buf = io.BytesIO()
+        img.save(buf, format="PNG", transparency=self.palette_alpha)
+        return buf.getvalue()
+
+    @staticmethod
+    def encode(rgba):
+        """
+        encode RGBA pixels of shape (rows, cols, 4) into PNG bytes
+        """
+        buf = io.BytesIO()
+        Image.fromarray(rgba, "RGBA").save(buf, format="PNG")
+        return buf.getvalue()
+
+
+def write_image(data, image_path):
+    """
+    write image bytes to a file
+
+    the file is written aside and renamed, so readers never see
+    half-written images
+    """
+    temp_path = "%s.%d.%d" % (image_path, os.getpid(), threading.get_ident())
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, image_path)
+
+
+def benchmark_encoding(dataset_path, n_rasters=24):
+    """
+    benchmark RGBA and palette PNG encoding on rasters of an existing dataset
+
+    -parameters-
+    dataset_path[str]: dataset file whose rasters are used
+    n_rasters[int]: number of rasters used, from the start of the timeline
+
+    -returns-
+    list of dict with mode, mean PNG bytes, mean data url bytes and mean encoding time in ms
+    """
+    with h5py.File(dataset_path, "r") as f:
+        timeline = f["meta"].attrs["timeline"].tolist()[:n_rasters]
+        cmap = eval(f["meta"].attrs["cmap"])
+        reader = RasterReader(f)
+        rasters = reader.read_many([t for t in timeline if t in reader])
+
+    results = []
+    print("%-10s %12s %14s %10s" % ("mode", "PNG bytes", "data url bytes", "ms/frame"))
+    for palette in (False, True):
+        renderer = RasterRenderer(cmap[0], cmap[1], cmap[2], palette)
+        start_time = time.time()
+        pngs = [renderer.png(raster) for raster in rasters]
+        encode_time = time.time() - start_time
+
+        size = np.mean([len(png) for png in pngs])
+        result = {
+            "mode": "palette" if palette else "rgba",
+            "bytes": size,
+            "url_bytes": np.mean([len(base64.b64encode(png)) + 22 for png in pngs]),
+            "ms": encode_time / len(pngs) * 1000
+        }
+        results.append(result)
+        print("%-10s %12.0f %14.0f %10.1f" % (
+            result["mode"], result["bytes"], result["url_bytes"], result["ms"]
+        ))
+
+    return results
@@ -0,0 +1,609 @@
+"""
+storage of rasters and their handoff between processes
+
+Author: @jiqicn
+"""
+import h5py
+import io
+import time
+import queue
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+
+LAYOUT_VERSION = 2  # layout of the data group in new dataset files, see RasterWriter
+CHUNK_SHAPE = (1, 128, 128)  # chunk shape (time, y, x) of layout 2, one raster per chunk
+                             # so single frames and windows decompress only what they need
+
+
+class Compression(object):
+    """
+    compression policy of rasters written to dataset files
+
+    codec: None (no compression), "lzf", or "gzip" with level 1-9
+    shuffle: apply the HDF5 shuffle filter before compression, which
+    usually improves the ratio of float rasters at little cost
+    """
+    CODECS = (None, "lzf", "gzip")
+
+    def __init__(self, codec="gzip", level=4, shuffle=True):
+        """
+        -parameters-
+        codec[str]: None, "lzf" or "gzip"
+        level[int]: gzip level, ignored by other codecs
+        shuffle[bool]: whether to apply the shuffle filter
+        """
+        if codec not in self.CODECS:
+            raise ValueError("Unknown compression codec %s" % codec)
+        if codec == "gzip" and level not in range(1, 10):
+            raise ValueError("gzip level should be within 1-9, got %s" % level)
+        self.codec = codec
+        self.level = level if codec == "gzip" else None
+        self.shuffle = shuffle and codec is not None
+
+    def __repr__(self):
+        return "Compression(%r, %r, shuffle=%r)" % (self.codec, self.level, self.shuffle)
+
+    def options(self):
+        """
+        keyword arguments of h5py create_dataset
+        """
+        return {
+            "compression": self.codec,
+            "compression_opts": self.level,
+            "shuffle": self.shuffle
+        }
+
+
+DEFAULT_COMPRESSION = Compression("gzip", 4, shuffle=True)
+
+
+class Quantization(object):
+    """
+    integer coding of rasters, where value = code * gain + offset
+
+    nan is stored as the nodata code, like the counts of ODIM files
+    """
+    def __init__(self, dtype, gain, offset, nodata):
+        """
+        -parameters-
+        dtype[str]: integer type of the codes, e.g. "uint8", "uint16"
+        gain, offset[float]: linear transformation from codes to values
+        nodata[int]: code of missing values
+        """
+        self.dtype = np.dtype(dtype)
+        self.gain = float(gain)
+        self.offset = float(offset)
+        self.nodata = int(nodata)
+
+    def __repr__(self):
+        return "Quantization(%r, %r, %r, %r)" % (
+            self.dtype.name, self.gain, self.offset, self.nodata
+        )
+
+    @classmethod
+    def from_attrs(cls, attrs):
+        """
+        get the coding of a stored raster, None if it is not quantized
+
+        -parameters-
+        attrs[h5py.AttributeManager]: attributes of the HDF5 dataset
+        """
+        if "gain" not in attrs:
+            return None
+        return cls(attrs["dtype"], attrs["gain"], attrs["offset"], attrs["nodata"])
+
+    def set_attrs(self, attrs):
+        """
+        write the coding to the attributes of a HDF5 dataset
+        """
+        attrs["dtype"] = self.dtype.name
+        attrs["gain"] = self.gain
+        attrs["offset"] = self.offset
+        attrs["nodata"] = self.nodata
+
+    def encode(self, data):
+        """
+        convert values to codes, rasters already coded are returned as they are
+        """
+        if data.dtype == self.dtype:
+            return data
+        # saturated values take the extreme codes, which exclude nodata
+        info = np.iinfo(self.dtype)
+        low, high = info.min, info.max
+        if self.nodata == high:
+            high -= 1
+        elif self.nodata == low:
+            low += 1
+        codes = np.rint((data - self.offset) / self.gain)
+        np.clip(codes, low, high, out=codes)
+        codes[np.isnan(data)] = self.nodata
+        return codes.astype(self.dtype)
+
+    def decode(self, codes):
+        """
+        convert codes to values, with nan for nodata
+        """
+        data = codes.astype("float64")
+        data *= self.gain
+        data += self.offset
+        data[codes == self.nodata] = np.nan
+        return data
+
+
+def track_frames():
+    """
+    start the resource tracker of shared memory, to be called before forking
+    the processes that pass frames
+
+    the forked processes share this tracker, which frees the blocks left by
+    killed workers or writers when the program exits
+    """
+    resource_tracker.ensure_running()
+
+
+def put_frames(q, names, frames, key=0):
+    """
+    hand frames over to the writer process through shared memory
+
+    frames are copied once into a shared memory block, and only a small
+    descriptor of the block goes through the queue
+
+    -parameters-
+    q[multiprocessing.Manager.Queue]: writing queue
+    names[list]: raster names, one per frame
+    frames[np.ndarray]: frames of shape (N, rows, cols)
+    key[int]: tells the writer where the frames go, e.g. which output dataset
+    """
+    frames = np.ascontiguousarray(frames)
+    shm = shared_memory.SharedMemory(create=True, size=max(frames.nbytes, 1))
+    buf = np.ndarray(frames.shape, dtype=frames.dtype, buffer=shm.buf)
+    buf[...] = frames
+    del buf  # release the buffer before closing the block
+    shm.close()
+
+    # the writer owns the block from now on and unlinks it after writing,
+    # or discard_frames does if the writer fails
+    try:
+        q.put({
+            "names": list(names),
+            "shm": shm.name,
+            "shape": frames.shape,
+            "dtype": frames.dtype.str,
+            "key": key
+        })
+    except BaseException:
+        unlink_frames(shm.name)
+        raise
+
+
+def get_frames(m, write):
+    """
+    pass the frames of a descriptor put by put_frames to a writing function
+
+    frames are views on the shared memory block, which is freed afterwards,
+    even if writing fails, so the writing function must not keep them
+
+    -parameters-
+    m[tuple]: descriptor from the writing queue
+    write[function]: called as write(raster_name, frame) for every frame
+    """
+    names = m["names"]
+    shm = shared_memory.SharedMemory(name=m["shm"])
+    try:
+        frames = np.ndarray(m["shape"], dtype=m["dtype"], buffer=shm.buf)
+        for i in range(len(names)):
+            write(names[i], frames[i])
+        del frames  # release the buffer before closing the block
+    finally:
+        # unlinked first, as closing fails while a traceback still holds a frame
+        shm.unlink()
+        try:
+            shm.close()
+        except BufferError:
+            pass  # unmapped once the frames are released
+
+
+def unlink_frames(shm_name):
+    """
+    free a shared memory block of put_frames that no writer will take
+    """
+    try:
+        shm = shared_memory.SharedMemory(name=shm_name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def discard_frames(q):
+    """
+    free the frames left in a writing queue, e.g. once its writer failed
+
+    workers putting frames should be stopped first, other items of the queue are dropped
+
+    -parameters-
+    q[multiprocessing.Manager.Queue]: writing queue
+    """
+    while True:
+        try:
+            m = q.get_nowait()
+        except queue.Empty:
+            return
+        if isinstance(m, dict) and "shm" in m:
+            unlink_frames(m["shm"])
+
+
+class RasterWriter(object):
+    """
+    write rasters into the data group of a dataset file
+
+    layout 1 stores every raster as its own HDF5 dataset named by its
+    timestamp, layout 2 stores all rasters in one chunked (time, y, x)
+    array "raster" with the timestamps in "time", in the same order
+
+    rasters of layout 2 are buffered until a time chunk is full and
+    written at once, so every chunk is compressed once rather than once
+    per raster. Buffered rasters are written by flush, which should be
+    called when done writing.
+    """
+    def __init__(self, f, layout=LAYOUT_VERSION, chunks=CHUNK_SHAPE,
+                 compression=DEFAULT_COMPRESSION, quantization=None):
+        """
+        -parameters-
+        f[h5py.File]: dataset file opened for writing
+        layout[int]: 1 or 2, see above
+        chunks[tuple]: chunk shape (time, y, x) of layout 2
+        compression[Compression]: compression policy of the rasters
+        quantization[Quantization]: store rasters as integer codes, None to store them as they are
+        """
+        self.group = f["data"]
+        self.chunks = chunks
+        self.compression = compression
+        self.quantization = quantization
+
+        # keep the layout of rasters already in the file
+        if "layout" in self.group.attrs:
+            layout = int(self.group.attrs["layout"])
+        elif len(self.group) > 0:
+            layout = 1  # written before layouts were recorded
+        self.layout = layout
+        self.group.attrs["layout"] = layout
+        self.slots = {}  # timestamp -> position along the time axis of rasters reserved
+        self.pending = []  # (timestamp, raster) not written yet, layout 2 only
+
+    def write(self, raster_name, data):
+        """
+        write one raster
+
+        -parameters-
+        raster_name[str]: timestamp of the raster
+        data[np.ndarray]: 2-D raster
+        """
+        if self.quantization is not None:
+            data = self.quantization.encode(data)
+
+        if self.layout == 1:
+            dset = self.group.create_dataset(
+                raster_name,
+                data=data,
+                **self.compression.options()
+            )
+            if self.quantization is not None:
+                self.quantization.set_attrs(dset.attrs)
+            return
+
+        # frames may be views on shared memory, so they are copied
+        self.pending.append((raster_name, np.array(data)))
+        raster, _ = self.__datasets(data.shape, data.dtype)
+        if (raster.shape[0] + len(self.pending)) % self.chunks[0] == 0:
+            self.flush()
+
+    def flush(self):
+        """
+        write the buffered rasters of layout 2
+        """
+        if len(self.pending) == 0:
+            return
+        raster, times = self.group["raster"], self.group["time"]
+        i = raster.shape[0]
+        n = len(self.pending)
+        raster.resize(i + n, axis=0)
+        times.resize(i + n, axis=0)
+        raster[i:] = np.stack([data for _, data in self.pending])
+        times[i:] = [rn for rn, _ in self.pending]
+        self.pending = []
+
+    def reserve(self, raster_names, shape):
+        """
+        add empty rasters, to be filled block by block with write_block
+
+        cells never written read as nan
+
+        -parameters-
+        raster_names[list]: timestamps of the rasters, in the order of the timeline
+        shape[tuple]: rows and cols of the rasters
+        """
+        self.flush()
+        shape = tuple(int(s) for s in shape)
+        dtype = np.dtype("float64") if self.quantization is None else self.quantization.dtype
+
+        if self.layout == 1:
+            for rn in raster_names:
+                dset = self.group.create_dataset(
+                    rn,
+                    shape=shape,
+                    dtype=dtype,
+                    chunks=tuple(min(c, s) for c, s in zip(self.chunks[1:], shape)),
+                    fillvalue=self.__fillvalue(dtype),
+                    **self.compression.options()
+                )
+                if self.quantization is not None:
+                    self.quantization.set_attrs(dset.attrs)
+            return
+
+        raster, times = self.__datasets(shape, dtype)
+        i = raster.shape[0]
+        raster.resize(i + len(raster_names), axis=0)
+        times.resize(i + len(raster_names), axis=0)
+        times[i:] = raster_names
+        for k, rn in enumerate(raster_names):
+            self.slots[rn] = i + k
+
+    def write_block(self, raster_names, data, row, col):
+        """
+        write a spatial block of rasters added by reserve
+
+        -parameters-
+        raster_names[list]: timestamps of the rasters
+        data[np.ndarray]: block of shape (len(raster_names), rows, cols)
+        row, col[int]: position of the upper-left cell of the block
+        """
+        if self.quantization is not None:
+            data = self.quantization.encode(data)
+        rows = slice(row, row + data.shape[1])
+        cols = slice(col, col + data.shape[2])
+
+        if self.layout == 1:
+            for rn, d in zip(raster_names, data):
+                self.group[rn][rows, cols] = d
+            return
+
+        slots = [self.slots[rn] for rn in raster_names]
+        if slots == list(range(slots[0], slots[0] + len(slots))):
+            self.group["raster"][slots[0]:slots[-1] + 1, rows, cols] = data
+        else:
+            for i, d in zip(slots, data):
+                self.group["raster"][i, rows, cols] = d
+
+    def truncate(self, raster_names):
+        """
+        remove the rasters written after the given ones, e.g. by an append that failed
+
+        -parameters-
+        raster_names[list]: timestamps of the rasters to be kept
+        """
+        self.pending = []
+        keep = set(raster_names)
+        if self.layout == 1:
+            for rn in list(self.group):
+                if rn not in keep:
+                    del self.group[rn]
+            return
+
+        # rasters are appended at the end of the time axis
+        if "time" not in self.group:
+            return
+        times = self.group["time"].asstr()[...]
+        n = 0
+        while n < len(times) and times[n] in keep:
+            n += 1
+        self.group["raster"].resize(n, axis=0)
+        self.group["time"].resize(n, axis=0)
+
+    def __fillvalue(self, dtype):
+        if self.quantization is not None:
+            return self.quantization.nodata
+        return np.nan if dtype.kind == 'f' else 0
+
+    def __datasets(self, shape, dtype):
+        """
+        get the raster and time arrays of layout 2, created on the first raster
+        """
+        if "raster" not in self.group:
+            # the time axis grows, so only the spatial chunk size is limited
+            chunks = (self.chunks[0], ) + tuple(
+                min(c, s) for c, s in zip(self.chunks[1:], shape)
+            )
+            dset = self.group.create_dataset(
+                "raster",
+                shape=(0, ) + tuple(shape),
+                maxshape=(None, ) + tuple(shape),
+                dtype=dtype,
+                chunks=chunks,
+                fillvalue=self.__fillvalue(np.dtype(dtype)),
+                **self.compression.options()
+            )
+            if self.quantization is not None:
+                self.quantization.set_attrs(dset.attrs)
+            self.group.create_dataset(
+                "time",
+                shape=(0, ),
+                maxshape=(None, ),
+                dtype=h5py.string_dtype(),
+                chunks=(1024, )
+            )
+        return self.group["raster"], self.group["time"]
+
+
+class RasterReader(object):
+    """
+    read rasters from the data group of a dataset file, in either layout
+
+    quantized rasters are decoded to float values on reading
+    """
+    def __init__(self, f):
+        """
+        -parameters-
+        f[h5py.File]: opened dataset file
+        """
+        self.group = f["data"]
+        self.layout = int(self.group.attrs.get("layout", 1))
+        self.index = {}  # timestamp -> position along the time axis, layout 2 only
+        self.quantization = None  # coding of the raster array, layout 2 only
+        if self.layout == 2 and "time" in self.group:
+            for i, t in enumerate(self.group["time"].asstr()[...]):
+                self.index[t] = i
+            self.quantization = Quantization.from_attrs(self.group["raster"].attrs)
+
+    def __contains__(self, raster_name):
+        if self.layout == 1:
+            return raster_name in self.group
+        return raster_name in self.index
+
+    def read(self, raster_name):
+        """
+        read one raster
+
+        -parameters-
+        raster_name[str]: timestamp of the raster
+
+        -returns-
+        2-D raster
+        """
+        if self.layout == 1:
+            return self.decode(self.group[raster_name])
+        return self.decode(self.group["raster"], self.index[raster_name])
+
+    def read_window(self, raster_name, rows, cols):
+        """
+        read a window of one raster, without reading the rest
+
+        -parameters-
+        raster_name[str]: timestamp of the raster
+        rows, cols[slice]: window to be read
+
+        -returns-
+        2-D array of the window
+        """
+        if self.layout == 1:
+            return self.decode(self.group[raster_name], (rows, cols))
+        return self.decode(self.group["raster"], (self.index[raster_name], rows, cols))
+
+    def read_many(self, raster_names):
+        """
+        read several rasters at once
+
+        -parameters-
+        raster_names[list]: timestamps of the rasters
+
+        -returns-
+        3-D array of shape (len(raster_names), rows, cols)
+        """
+        if self.layout == 1:
+            return np.stack([self.decode(self.group[rn]) for rn in raster_names])
+
+        # h5py only takes increasing indices, so read sorted and reorder
+        index = np.array([self.index[rn] for rn in raster_names], dtype=int)
+        index, inverse = np.unique(index, return_inverse=True)
+        if len(index) > 0 and index[-1] - index[0] + 1 == len(index):
+            data = self.decode(self.group["raster"], slice(index[0], index[-1] + 1))
+        else:
+            data = self.decode(self.group["raster"], index.tolist())
+        return data[inverse]
+
+    def read_series(self, row, col, raster_names):
+        """
+        read the time series of one pixel
+
+        -parameters-
+        row, col[int]: position of the pixel
+        raster_names[list]: timestamps to be read
+
+        -returns-
+        1-D array, one value per raster name
+        """
+        if self.layout == 1:
+            return np.array([self.decode(self.group[rn], (row, col)) for rn in raster_names])
+
+        series = self.decode(self.group["raster"], (slice(None), row, col))
+        return series[[self.index[rn] for rn in raster_names]]
+
+    def decode(self, dset, selection=Ellipsis):
+        """
+        read a selection of a HDF5 dataset and decode it if quantized
+
+        -parameters-
+        dset[h5py.Dataset]: stored rasters
+        selection: index of the selection, default to be the whole dataset
+        """
+        data = dset[selection]
+        if self.layout == 2:
+            quantization = self.quantization
+        else:
+            quantization = Quantization.from_attrs(dset.attrs)
+        if quantization is None:
+            return data
+        return quantization.decode(np.asarray(data))
+
+
+def benchmark_compression(dataset_path, policies=None, n_rasters=24, layout=LAYOUT_VERSION):
+    """
+    benchmark compression policies on rasters of an existing dataset
+
+    rasters are written to and read back from in-memory HDF5 files,
+    so the numbers reflect the cost of the filters rather than the disk
+
+    -parameters-
+    dataset_path[str]: dataset file whose rasters are used
+    policies[list]: Compression objects, default to a range of codecs and levels
+    n_rasters[int]: number of rasters used, from the start of the timeline
+    layout[int]: layout of the data group written
+
+    -returns-
+    list of dict with policy, write MB/s, read MB/s and compression ratio
+    """
+    if policies is None:
+        policies = [Compression(None, shuffle=False), Compression("lzf", shuffle=False),
+                    Compression("lzf", shuffle=True)]
+        for level in (1, 4, 6, 9):
+            policies.append(Compression("gzip", level, shuffle=False))
+            policies.append(Compression("gzip", level, shuffle=True))
+
+    with h5py.File(dataset_path, "r") as f:
+        timeline = f["meta"].attrs["timeline"].tolist()[:n_rasters]
+        rasters = RasterReader(f).read_many(timeline)
+    raw_mb = rasters.nbytes / 2**20
+
+    results = []
+    print("%-40s %12s %12s %8s" % ("policy", "write MB/s", "read MB/s", "ratio"))
+    for policy in policies:
+        bio = io.BytesIO()
+        start_time = time.time()
+        with h5py.File(bio, "w") as f:
+            f.create_group("data")
+            writer = RasterWriter(f, layout, compression=policy)
+            for i in range(len(timeline)):
+                writer.write(timeline[i], rasters[i])
+            writer.flush()
+        write_time = time.time() - start_time
+
+        start_time = time.time()
+        with h5py.File(bio, "r") as f:
+            reader = RasterReader(f)
+            for t in timeline:
+                reader.read(t)
+        read_time = time.time() - start_time
+
+        result = {
+            "policy": repr(policy),
+            "write": raw_mb / write_time,
+            "read": raw_mb / read_time,
+            "ratio": rasters.nbytes / len(bio.getvalue())
+        }
+        results.append(result)
+        print("%-40s %12.1f %12.1f %8.2f" % (
+            result["policy"], result["write"], result["read"], result["ratio"]
+        ))
+
+    return results
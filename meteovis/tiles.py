@@ -0,0 +1,292 @@
+"""
+XYZ tiles of dataset rasters and their local endpoint
+
+Author: @jiqicn
+"""
+import math
+import threading
+import numpy as np
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from .geometry import ResamplePlan
+from .render import RasterRenderer
+
+
+TILE_SIZE = 256  # rows and cols of a tile, in pixels
+WORLD_EXTENT = 20037508.342789244  # half the width of the epsg3857 world, in metres
+TILE_CACHE_BYTES = 128 * 1024 ** 2  # memory budget of the rendered tiles of a pyramid, in bytes
+OVERVIEW_FRAMES = 4  # number of frames whose overviews are kept in memory
+TILE_PORT = 0  # port of the tile endpoint, 0 to take any free port
+TILE_URL = "http://localhost:{port}"  # base url of the tile endpoint as seen by the browser,
+                                      # e.g. "/proxy/{port}" behind jupyter-server-proxy
+EMPTY_TILE = RasterRenderer.encode(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+TILE_SERVER = None  # tile endpoint of the current process, see TileServer.get
+
+
+class TilePyramid(object):
+    """
+    web-mercator tiles of the rasters of a dataset, rendered on request
+
+    tiles zoomed in beyond the native resolution sample the raster itself,
+    reading only the window under the tile. Tiles zoomed out use overview
+    levels, which average blocks of 2^level x 2^level cells, so every tile
+    pixel covers about one cell. Rendered tiles are kept in a
+    least-recently-used buffer.
+    """
+    def __init__(self, dataset, max_bytes=TILE_CACHE_BYTES):
+        """
+        -parameters-
+        dataset[Dataset]: dataset of rasters on an epsg3857 grid
+        max_bytes[int]: memory budget of the rendered tiles, in bytes
+        """
+        self.dataset = dataset
+        self.renderer = RasterRenderer.get(*dataset.cmap)
+        self.bbox = dataset.bbox_metre
+        self.res = [int(r) for r in dataset.res]
+        self.cell = max(
+            (self.bbox[1][0] - self.bbox[0][0]) / self.res[0],
+            (self.bbox[1][1] - self.bbox[0][1]) / self.res[1]
+        )
+        self.n_levels = int(math.log2(min(self.res))) + 1  # the coarsest level has cells left
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.tiles = OrderedDict()  # (raster_name, z, x, y) -> png bytes
+        self.overviews = OrderedDict()  # raster_name -> overview levels, level 0 excluded
+        self.lock = threading.RLock()  # tiles are requested by threads of the endpoint
+
+    def zoom_range(self):
+        """
+        -returns-
+        (min_zoom, max_zoom), from the zoom where the dataset fits into one
+        tile to the zoom where a pixel is about one cell
+        """
+        extent = max(self.bbox[1][0] - self.bbox[0][0], self.bbox[1][1] - self.bbox[0][1])
+        min_zoom = int(math.floor(math.log2(2 * WORLD_EXTENT / extent)))
+        max_zoom = int(math.ceil(math.log2(2 * WORLD_EXTENT / (TILE_SIZE * self.cell))))
+        return max(min_zoom, 0), max(max_zoom, 0)
+
+    def tile_range(self, z):
+        """
+        x and y of the tiles overlapping the dataset at a zoom
+
+        -returns-
+        (range of x, range of y)
+        """
+        size = 2 * WORLD_EXTENT / 2 ** z
+        n = 2 ** z
+        x0 = int((self.bbox[0][1] + WORLD_EXTENT) // size)
+        x1 = int(math.ceil((self.bbox[1][1] + WORLD_EXTENT) / size)) - 1
+        y0 = int((WORLD_EXTENT - self.bbox[1][0]) // size)
+        y1 = int(math.ceil((WORLD_EXTENT - self.bbox[0][0]) / size)) - 1
+        return range(max(x0, 0), min(x1, n - 1) + 1), range(max(y0, 0), min(y1, n - 1) + 1)
+
+    def get(self, raster_name, z, x, y):
+        """
+        get a tile from the buffer, or render it if missing
+
+        -parameters-
+        raster_name[str]
+        z, x, y[int]: XYZ address of the tile
+
+        -returns-
+        png bytes, a transparent tile if the dataset has no data there
+        """
+        key = (raster_name, z, x, y)
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                return self.tiles[key]
+
+        tile = self.render(raster_name, z, x, y)
+        with self.lock:
+            self.tiles[key] = tile
+            self.nbytes += len(tile)
+            while self.nbytes > self.max_bytes and len(self.tiles) > 1:
+                _, old = self.tiles.popitem(last=False)
+                self.nbytes -= len(old)
+        return tile
+
+    def build(self, raster_name, zooms=None):
+        """
+        render the tile pyramid of a frame ahead of requests
+
+        -parameters-
+        raster_name[str]
+        zooms[list]: zoom levels to build, default to be the whole zoom_range
+
+        -returns-
+        number of tiles of the pyramid
+        """
+        if zooms is None:
+            min_zoom, max_zoom = self.zoom_range()
+            zooms = range(min_zoom, max_zoom + 1)
+        n = 0
+        for z in zooms:
+            xs, ys = self.tile_range(z)
+            for x in xs:
+                for y in ys:
+                    self.get(raster_name, z, x, y)
+                    n += 1
+        return n
+
+    def render(self, raster_name, z, x, y):
+        """
+        render a tile, see get
+        """
+        if not self.dataset.has_raster(raster_name):
+            return EMPTY_TILE
+
+        # bbox of the pixel centres of the tile
+        size = 2 * WORLD_EXTENT / 2 ** z
+        pixel = size / TILE_SIZE
+        x_min = -WORLD_EXTENT + x * size
+        y_max = WORLD_EXTENT - y * size
+        bbox_tile = [
+            [y_max - size + 0.5 * pixel, x_min + 0.5 * pixel],
+            [y_max - 0.5 * pixel, x_min + size - 0.5 * pixel]
+        ]
+
+        # the coarsest level whose cells are not larger than a pixel
+        level = 0
+        if pixel > self.cell:
+            level = min(int(math.log2(pixel / self.cell)), self.n_levels - 1)
+        bbox, res = self.level_grid(level)
+        window, plan = ResamplePlan(bbox, res, bbox_tile, (TILE_SIZE, TILE_SIZE)).tile(
+            slice(None), slice(None)
+        )
+        if window is None:
+            return EMPTY_TILE
+
+        if level == 0:
+            with self.dataset.reader() as reader:
+                data = reader.read_window(raster_name, *window)
+        else:
+            data = self.overview(raster_name, level)[window]
+        return self.renderer.png(plan.resample(data))
+
+    def level_grid(self, level):
+        """
+        bbox and res of an overview level, cells left over at the south and east are dropped
+        """
+        f = 2 ** level
+        res = [self.res[0] // f, self.res[1] // f]
+        y_step = (self.bbox[1][0] - self.bbox[0][0]) / self.res[0] * f
+        x_step = (self.bbox[1][1] - self.bbox[0][1]) / self.res[1] * f
+        bbox = [
+            [self.bbox[1][0] - res[0] * y_step, self.bbox[0][1]],
+            [self.bbox[1][0], self.bbox[0][1] + res[1] * x_step]
+        ]
+        return bbox, res
+
+    def overview(self, raster_name, level):
+        """
+        overview level of a frame, all levels of a frame are computed at once
+
+        every cell is the mean of the valid cells of a 2 x 2 block of the level below
+        """
+        with self.lock:
+            if raster_name in self.overviews:
+                self.overviews.move_to_end(raster_name)
+                return self.overviews[raster_name][level - 1]
+
+        levels = []
+        data = self.dataset.read_raster(raster_name)
+        for _ in range(1, self.n_levels):
+            rows, cols = data.shape[0] // 2, data.shape[1] // 2
+            block = data[:2 * rows, :2 * cols].reshape(rows, 2, cols, 2)
+            valid = ~np.isnan(block)
+            count = valid.sum(axis=(1, 3))
+            total = np.where(valid, block, 0).sum(axis=(1, 3))
+            data = np.full((rows, cols), np.nan)
+            np.divide(total, count, out=data, where=count > 0)
+            levels.append(data)
+
+        with self.lock:
+            self.overviews[raster_name] = levels
+            while len(self.overviews) > OVERVIEW_FRAMES:
+                self.overviews.popitem(last=False)
+        return levels[level - 1]
+
+
+class TileServer(object):
+    """
+    local HTTP endpoint serving tiles of pyramids, consumed by TileLayer of ipyleaflet
+
+    tiles are addressed as /<pyramid key>/<raster_name>/<z>/<x>/<y>.png,
+    so the browser only fetches the tiles in the viewport at the current zoom
+    """
+    def __init__(self, port=TILE_PORT, url=TILE_URL):
+        """
+        -parameters-
+        port[int]: port to listen on, 0 to take any free port
+        url[str]: base url of the endpoint as seen by the browser, with {port} filled in
+        """
+        self.pyramids = {}  # key -> TilePyramid
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                tile = server.tile(self.path)
+                if tile is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(tile)))
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.end_headers()
+                self.wfile.write(tile)
+
+            def log_message(self, *args):
+                pass  # keep the notebook output clean
+
+        self.httpd = ThreadingHTTPServer(("localhost", port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.base_url = url.format(port=self.port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get(cls):
+        """
+        get the endpoint of the current process, started on first use
+        """
+        global TILE_SERVER
+        if TILE_SERVER is None:
+            TILE_SERVER = cls()
+        return TILE_SERVER
+
+    def add(self, key, pyramid):
+        """
+        serve the tiles of a pyramid under a key
+        """
+        self.pyramids[key] = pyramid
+
+    def url(self, key, raster_name):
+        """
+        url template of the tiles of a frame, for TileLayer
+        """
+        return "%s/%s/%s/{z}/{x}/{y}.png" % (self.base_url, key, raster_name)
+
+    def tile(self, path):
+        """
+        tile of a request path, None if the path is not a tile of a frame of the dataset
+        """
+        parts = path.split("?")[0].strip("/").split("/")
+        if len(parts) != 5 or parts[0] not in self.pyramids or not parts[4].endswith(".png"):
+            return None
+        try:
+            z, x, y = int(parts[2]), int(parts[3]), int(parts[4][:-4])
+        except ValueError:
+            return None
+        if z < 0 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return None
+        pyramid = self.pyramids[parts[0]]
+        if not pyramid.dataset.has_raster(parts[1]):
+            return None
+        return pyramid.get(parts[1], z, x, y)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -9,24 +9,36 @@ import matplotlib.pyplot as plt
 import multiprocessing as mp
 import h5py
 import os
-from ipyleaflet import Map, basemaps, FullScreenControl, ImageOverlay, WidgetControl
+from ipyleaflet import Map, basemaps, FullScreenControl, ImageOverlay, TileLayer, WidgetControl
 import base64
 import io
 import numpy as np
+from .storage import RasterReader
+from .render import RasterRenderer
+from .cache import RenderCache, CACHE_BYTES, image_prefix
+from .tiles import TilePyramid, TileServer
 
 
 CACHE_DIR = os.getcwd() + "/cache"
 EMPTY_IMAGE = "data:image/png;base64,R0lGODlhAQABAAAAACwAAAAAAQABAAA="
+RENDER_BYTES = 128 * 1024 ** 2  # memory budget of the block of rasters rendered together by one worker, in bytes
 
 
 class View(object):
     """
     interactive map view of dataset
     """
-    def __init__(self, dataset):
+    def __init__(self, dataset, tiles=False):
+        """
+        -parameters-
+        dataset[Dataset]
+        tiles[bool]: show frames as XYZ tiles from a local endpoint, so only the tiles in 
+            the viewport are fetched, instead of one image of the whole raster
+        """
         self.dataset = dataset
         self.id = dataset.id
         self.timeline = dataset.timeline
+        self.image_prefix = image_prefix(dataset.id, *dataset.cmap)  # names of images in cache
         
         # interactive map
         self.map = Map(
@@ -75,11 +87,24 @@ class View(object):
         )
         
         # raster layer
-        self.raster = ImageOverlay(
-            url=EMPTY_IMAGE, 
-            bounds=dataset.bbox, 
-            opacity=1
-        )
+        self.pyramid = None
+        if tiles:
+            self.pyramid = TilePyramid(dataset)
+            self.tile_server = TileServer.get()
+            self.tile_server.add(self.image_prefix, self.pyramid)
+            min_zoom, max_zoom = self.pyramid.zoom_range()
+            self.raster = TileLayer(
+                url=self.tile_server.url(self.image_prefix, self.timeline[0]), 
+                max_native_zoom=max_zoom, 
+                no_wrap=True, 
+                opacity=1
+            )
+        else:
+            self.raster = ImageOverlay(
+                url=EMPTY_IMAGE, 
+                bounds=dataset.bbox, 
+                opacity=1
+            )
         self.map.add_layer(self.raster)
         
     def update_raster(self, img):
@@ -96,73 +121,144 @@ class View(object):
         if img is not None:
             self.raster.url = img
         
-    def create_cache(self, cache_dir=CACHE_DIR):
+    def update_tiles(self, raster_name):
+        """
+        point the tile layer to the tiles of a frame, kept the same if the dataset has no such frame
+        
+        -parameters-
+        raster_name[str]
+        """
+        if self.dataset.has_raster(raster_name):
+            self.raster.url = self.tile_server.url(self.image_prefix, raster_name)
+    
+    def image_name(self, raster_name):
+        """
+        name of the cached image of a raster
+        """
+        return image_name(self.image_prefix, raster_name)
+    
+    def create_cache(self, cache_dir=CACHE_DIR, max_bytes=CACHE_BYTES):
         """
         arrange rendering in parallel and keep the resulting images into cache
         
+        images of the view are recorded as used in the cache manifest, and 
+        the least recently used images of other views are removed if the 
+        cache is over its budget
+        
         -parameters-
         cache_dir[str]: path to the cache directory, default to be CACHE_DIR
+        max_bytes[int]: disk budget of the cache, in bytes
         """
-        dataset_id = self.id
+        prefix = self.image_prefix
         dataset_path = self.dataset.dataset_path
         cmap = self.dataset.cmap[0]
         vmin = self.dataset.cmap[1]
         vmax = self.dataset.cmap[2]
-        raster_names = self.timeline
         pool = mp.Pool(mp.cpu_count() + 2)
         jobs = []
         
+        # only missing images are rendered, in blocks of consecutive rasters
+        raster_names = [
+            rn for rn in self.timeline 
+            if not os.path.isfile(image_path(cache_dir, prefix, rn))
+        ]
+        
         print("Rendering and caching %s......" % self.dataset.name, end="", flush=True)
-        for rn in raster_names:
+        block_size = self.render_block_size()
+        for i in range(0, len(raster_names), block_size):
             job = pool.apply_async(
-                self.render_image, 
-                (dataset_id, dataset_path, cmap, vmin, vmax, cache_dir, rn)
+                self.render_block, 
+                (prefix, dataset_path, cmap, vmin, vmax, cache_dir, raster_names[i:i+block_size])
             )
             jobs.append(job)
         for job in jobs:
             job.get()
         pool.close()
         pool.join()
+        
+        cache = RenderCache(cache_dir, max_bytes)
+        image_names = [self.image_name(rn) for rn in self.timeline]
+        cache.add(self.id, image_names)
+        cache.evict(keep=image_names)
         print("[Done]")
     
+    def render_block_size(self):
+        """
+        number of rasters rendered together within RENDER_BYTES, at least one
+        
+        a block takes the rasters read as float64, and the arrays of the renderer
+        """
+        renderer = RasterRenderer.get(*self.dataset.cmap)
+        cell_bytes = 8 + renderer.cell_bytes()
+        return max(1, int(RENDER_BYTES // (int(np.prod(self.dataset.res)) * cell_bytes)))
+    
+    def render(self, raster_names, cache_dir=CACHE_DIR):
+        """
+        render rasters into the cache in the current process, for rendering frames on demand
+        
+        -parameters-
+        raster_names[list]
+        cache_dir[str]: path to the cache directory, default to be CACHE_DIR
+        """
+        cmap, vmin, vmax = self.dataset.cmap
+        self.render_block(
+            self.image_prefix, self.dataset.dataset_path, cmap, vmin, vmax, cache_dir, raster_names
+        )
+        RenderCache(cache_dir).add(self.id, [self.image_name(rn) for rn in raster_names])
+    
     @staticmethod
-    def render_image(dataset_id, dataset_path, cmap, vmin, vmax,
+    def render_block(image_prefix, dataset_path, cmap, vmin, vmax, 
+                     cache_dir, raster_names):
+        """
+        render a block of rasters into images, with the dataset file opened once
+        
+        -parameters-
+        image_prefix[str]: prefix of the image names, see cache.image_prefix
+        dataset_path[str]
+        cmap[str]: colormap name that is available in matplotlib
+        vmin, vmax[int]: value range to be colored
+        cache_dir[str]
+        raster_names[list]
+        """
+        with h5py.File(dataset_path, "r") as f:
+            reader = RasterReader(f)
+            raster_names = [rn for rn in raster_names if rn in reader]
+            if len(raster_names) == 0:
+                return
+            rasters = reader.read_many(raster_names)
+        RasterRenderer.get(cmap, vmin, vmax).save_block(
+            rasters, 
+            [image_path(cache_dir, image_prefix, rn) for rn in raster_names]
+        )
+    
+    @staticmethod
+    def render_image(image_prefix, dataset_path, cmap, vmin, vmax,
                      cache_dir, raster_name):
         """
         render a raster into an image
         
         -parameters-
-        dataset_id[str]
+        image_prefix[str]: prefix of the image names, see cache.image_prefix
         dataset_path[str]
         cmap[str]: colormap name that is available in matplotlib
         vmin, vmax[int]: value range to be colored
         cache_dir[str]
         raster_name[str]
         """
-        image_name = dataset_id + "_" + raster_name + ".png"
-        image_path = os.path.join(cache_dir, image_name)
-        if os.path.isfile(image_path): 
+        if os.path.isfile(image_path(cache_dir, image_prefix, raster_name)): 
             return
-        
-        with h5py.File(dataset_path, "r") as f:
-            raster = f["data"][raster_name][...]
-        
-        fig_size = (raster.shape[1], raster.shape[0])
-        fig = plt.figure(figsize=fig_size, dpi=1)
-        fig.add_axes([0, 0, 1, 1])
-        plt.imshow(
-            raster, 
-            cmap=cmap, 
-            vmin=vmin, 
-            vmax=vmax, 
-        )
-        plt.axis("off")
-        fig.savefig(
-            image_path, 
-            transparent=True,
-            bbox_inches="tight", 
-            pad_inches=0, 
-            dpi=1, 
-        )
-        plt.close()
-        
\ No newline at end of file
+        View.render_block(image_prefix, dataset_path, cmap, vmin, vmax, cache_dir, [raster_name])
+
+
+def image_name(image_prefix, raster_name):
+    """
+    name of the cached image of a raster
+    """
+    return image_prefix + "_" + raster_name + ".png"
+
+
+def image_path(cache_dir, image_prefix, raster_name):
+    """
+    path of the cached image of a raster
+    """
+    return os.path.join(cache_dir, image_name(image_prefix, raster_name))